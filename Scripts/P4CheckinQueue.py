@@ -0,0 +1,98 @@
+import logging
+import traceback
+
+try:
+    from PySide2.QtCore import *
+except:
+    from PySide.QtCore import *
+
+import P4
+
+from P4ConnectionManager import P4ConnectionManager
+from P4IdleWorker import P4IdleWorker
+
+logger = logging.getLogger(__name__)
+
+
+class CheckinJob(object):
+    def __init__(self, filepath, p4path, settings, reconcile=False):
+        self.filepath = filepath
+        self.p4path = p4path
+        self.reconcile = reconcile
+        # (port, user, client, password) captured on the main thread
+        self.settings = settings
+        self.workspacePath = ""
+        self.error = ""
+
+
+class CheckinProgress(P4.Progress, P4.OutputHandler):
+    """
+    P4 progress and output handler for a running check-in, forwards everything to the queue's signals.
+    The job's own steps (copying files etc.) report through the same interface.
+    """
+    def __init__(self, checkinQueue, job):
+        P4.Progress.__init__(self)
+        P4.OutputHandler.__init__(self)
+        self.checkinQueue = checkinQueue
+        self.job = job
+        self.description = ""
+        self.total = 0
+        self.position = 0
+
+    def setDescription(self, description, units):
+        P4.Progress.setDescription(self, description, units)
+        self.position = 0
+        self._emit()
+
+    def setTotal(self, total):
+        P4.Progress.setTotal(self, total)
+        self._emit()
+
+    def update(self, position):
+        P4.Progress.update(self, position)
+        self._emit()
+
+    def outputMessage(self, e):
+        logger.info("{}: {}".format(self.job.filepath, e))
+        return P4.OutputHandler.REPORT
+
+    def _emit(self):
+        self.checkinQueue.progress.emit(self.job.filepath, self.description, int(self.position or 0), int(self.total or 0))
+
+
+class P4CheckinQueue(QObject):
+    """
+    Runs check-in jobs one after another on a worker thread, so exports queue up instead
+    of blocking the DCC. Each job checks out a connection from the pool of connections,
+    which can be shared with the plugin's other background work.
+
+    run(p4, job, progress) does the actual work for a job on the worker thread, it must not
+    touch any widgets. The signals are emitted from the worker thread, connect them with
+    Qt.QueuedConnection.
+    """
+    progress = Signal(str, str, int, int)
+    jobFinished = Signal(object)
+
+    def __init__(self, run, connections=None, parent=None):
+        super(P4CheckinQueue, self).__init__(parent)
+        self.run = run
+        self.connections = connections or P4ConnectionManager()
+        self._worker = P4IdleWorker(self._runJob, "P4Checkin")
+
+    def pending(self):
+        return self._worker.items.qsize()
+
+    def put(self, filepath, p4path, settings, reconcile=False):
+        job = CheckinJob(filepath, p4path, settings, reconcile)
+        self._worker.put(job)
+        return job
+
+    def _runJob(self, job):
+        handler = CheckinProgress(self, job)
+        try:
+            with self.connections.pooled(*job.settings) as p4:
+                self.run(p4, job, handler)
+        except Exception as why:
+            logger.error(traceback.format_exc())
+            job.error = str(why)
+        self.jobFinished.emit(job)
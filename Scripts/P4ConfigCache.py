@@ -0,0 +1,102 @@
+import os
+import copy
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def mergeConfig(target, data):
+    """Recursively merge data into target and return target"""
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            mergeConfig(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+class PerforceConfigCache(object):
+    """
+    In-memory cache of the perforce.yml files stored in the entity folders.
+
+    Each file is kept with its mtime and size and only read again when a stat shows
+    it changed on disk. Writes go straight to the file and only drop that file from
+    the cache, Prism's own config cache is left alone.
+
+    queue() buffers writes instead: edits to the same file are merged and written
+    once by flush(). Reads already see the queued values.
+    """
+    FILENAME = "perforce.yml"
+
+    def __init__(self, core):
+        self.core = core
+        self._configs = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def getConfigPath(self, configRoot):
+        return os.path.join(configRoot, self.FILENAME)
+
+    def get(self, param, configRoot):
+        path = os.path.normpath(self.getConfigPath(configRoot))
+        data = self._load(path)
+        with self._lock:
+            if path in self._pending:
+                data = mergeConfig(copy.deepcopy(data), self._pending[path])
+        return data.get(param)
+
+    def set(self, data, configRoot):
+        path = self.getConfigPath(configRoot)
+        with self._lock:
+            self.core.setConfig(data={"perforce": data}, configPath=path)
+            self.invalidate(configRoot)
+
+    def queue(self, data, configRoot):
+        path = os.path.normpath(self.getConfigPath(configRoot))
+        with self._lock:
+            mergeConfig(self._pending.setdefault(path, {}), data)
+
+    def hasPending(self):
+        with self._lock:
+            return bool(self._pending)
+
+    def flush(self):
+        """Write all queued edits, one write per file"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for path, data in pending.items():
+                logger.debug("Writing queued perforce config to {}".format(path))
+                self.core.setConfig(data={"perforce": data}, configPath=path)
+                self._configs.pop(path, None)
+
+    def invalidate(self, configRoot=None):
+        with self._lock:
+            if configRoot is None:
+                self._configs.clear()
+            else:
+                self._configs.pop(os.path.normpath(self.getConfigPath(configRoot)), None)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _load(self, path):
+        path = os.path.normpath(path)
+        stamp = self._stat(path)
+        with self._lock:
+            cached = self._configs.get(path)
+            if cached and cached[0] == stamp:
+                return cached[1]
+
+            if stamp is None:
+                data = {}
+            else:
+                # The file changed since we last saw it, so Prism's cached copy may be stale too
+                data = self.core.getConfig("perforce", configPath=path, allowCache=False) or {}
+                logger.debug("Read {}".format(path))
+            self._configs[path] = (stamp, data)
+            return data
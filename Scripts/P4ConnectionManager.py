@@ -0,0 +1,172 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import P4
+
+from P4ConnectionPool import P4ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class P4ConnectionManager(object):
+    """
+    Keeps one live P4 session per (port, user, client).
+
+    A session is only reconnected when the server actually dropped it, and the
+    login ticket is only re-checked with 'p4 login -s' once the cached check
+    expires, so repeated calls from hooks and menus cost no server round-trip.
+
+    A session is only meant for the main thread. Work on other threads checks out
+    a connection of the same settings from a pool with pooled().
+    """
+    # Seconds a successful 'p4 login -s' is trusted before checking again
+    TICKET_TTL = 300
+    # Connections per (port, user, client) that pooled() keeps open at most
+    POOL_SIZE = 4
+
+    def __init__(self, ticketTTL=None, poolSize=None):
+        self.ticketTTL = self.TICKET_TTL if ticketTTL is None else ticketTTL
+        self.poolSize = poolSize or self.POOL_SIZE
+        self._sessions = {}
+        self._pools = {}
+        self._passwords = {}
+        self._validUntil = {}
+        self._lock = threading.RLock()
+
+    def connection(self, port, user, client, password=None, force=False):
+        """
+        Return a connected and logged in P4 session for the given settings.
+        force skips the cached ticket check.
+        Raises P4.P4Exception if the server can't be reached or login fails.
+        """
+        key = (port, user, client)
+        with self._lock:
+            p4 = self._sessions.get(key)
+            if p4 is None:
+                p4 = P4.P4()
+                p4.port = port
+                p4.user = user
+                p4.client = client
+                self._sessions[key] = p4
+            if password:
+                p4.password = password
+
+            if not p4.connected() or p4.dropped():
+                self._reconnect(p4)
+                self._validUntil.pop(key, None)
+
+            self._checkLogin(key, p4, force)
+            return p4
+
+    def pool(self, port, user, client, password=None):
+        """Return the P4ConnectionPool for the given settings, its connections aren't checked for a login"""
+        key = (port, user, client)
+        with self._lock:
+            if password:
+                self._passwords[key] = password
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = P4ConnectionPool(lambda: self._newConnection(key), size=self.poolSize)
+                self._pools[key] = pool
+            return pool
+
+    @contextmanager
+    def pooled(self, port, user, client, password=None, force=False, **context):
+        """
+        Check out a logged in connection for the with block, safe to use from any thread.
+        Keyword arguments are set on the connection for the block, like P4.saved_context.
+        Raises P4.P4Exception if the server can't be reached, login fails or the pool is closed.
+        """
+        key = (port, user, client)
+        with self.pool(port, user, client, password).connection(**context) as p4:
+            # The ticket is shared by all connections of the same user, so is the cached check
+            self._checkLogin(key, p4, force)
+            yield p4
+
+    def invalidate(self, port=None, user=None, client=None):
+        """Forget cached ticket checks so the next connection() verifies the login again"""
+        with self._lock:
+            if port is None:
+                self._validUntil.clear()
+            else:
+                self._validUntil.pop((port, user, client), None)
+
+    def probe(self, port, user, client, password=None, force=False):
+        """
+        Check that the server can be reached and logged into, safe to call from any thread.
+        Uses a pooled connection, the main thread's session isn't touched.
+        Raises P4.P4Exception on failure.
+        """
+        with self.pooled(port, user, client, password, force=force):
+            pass
+
+    def disconnectAll(self):
+        with self._lock:
+            for p4 in self._sessions.values():
+                try:
+                    if p4.connected():
+                        p4.disconnect()
+                except P4.P4Exception as why:
+                    logger.debug(why)
+            # Checked out connections are closed when they come back
+            for pool in self._pools.values():
+                pool.close()
+            self._sessions.clear()
+            self._pools.clear()
+            self._passwords.clear()
+            self._validUntil.clear()
+
+    def _checkLogin(self, key, p4, force=False):
+        with self._lock:
+            if not force and time.time() < self._validUntil.get(key, 0):
+                return
+        try:
+            ttl = self._login(p4)
+        except P4.P4Exception:
+            with self._lock:
+                self._validUntil.pop(key, None)
+            raise
+        with self._lock:
+            self._validUntil[key] = time.time() + ttl
+
+    def _newConnection(self, key):
+        p4 = P4.P4()
+        p4.port, p4.user, p4.client = key
+        with self._lock:
+            password = self._passwords.get(key)
+        if password:
+            p4.password = password
+        self._reconnect(p4)
+        return p4
+
+    def _reconnect(self, p4):
+        try:
+            if p4.connected():
+                p4.disconnect()
+        except P4.P4Exception:
+            pass
+        logger.info("Connecting to {} as {}".format(p4.port, p4.user))
+        try:
+            p4.connect()
+        except P4.P4Exception as why:
+            raise P4.P4Exception("Failed to connect to p4. {}".format(why))
+
+    def _login(self, p4):
+        """Login if needed and return the number of seconds the result can be cached"""
+        try:
+            result = p4.run_login('-s')
+        except P4.P4Exception:
+            try:
+                p4.run_login()
+            except P4.P4Exception as why:
+                raise P4.P4Exception("Failed to login to p4. {}".format(why))
+            return self.ticketTTL
+
+        # Never trust the cache longer than the ticket itself is valid
+        try:
+            expiration = int(result[0].get("TicketExpiration"))
+        except (IndexError, AttributeError, TypeError, ValueError):
+            return self.ticketTTL
+        return max(0, min(self.ticketTTL, expiration))
@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import P4
+
+logger = logging.getLogger(__name__)
+
+
+class P4ConnectionPool(object):
+    """
+    Thread safe pool of P4 connections, opened by a connect function.
+
+    At most size connections are open at the same time. checkout() waits until one
+    is free and checkin() gives it back. connection() does both for a with block
+    and restores the context of the connection afterwards, so a caller can change
+    cwd, exception_level etc. without affecting the next one.
+
+    Only the public P4Python API is used, so this works with whichever P4 module
+    the DCC provides.
+    """
+    SIZE = 4
+
+    def __init__(self, connect, size=None):
+        # connect() returns a new connected P4 object or raises P4.P4Exception
+        self.connect = connect
+        self.size = size or self.SIZE
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        # clear() bumps the generation, connections from older generations aren't reused
+        self._generation = 0
+        self._checkedOut = {}
+        self._cond = threading.Condition()
+
+    def checkout(self, timeout=None):
+        """
+        Return a connected P4 object, which must be given back with checkin().
+        Raises P4.P4Exception if the pool is closed or no connection got free within timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise P4.P4Exception("Connection pool is closed")
+                generation = self._generation
+                if self._idle:
+                    p4 = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    p4 = None
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise P4.P4Exception("Timed out waiting for a free connection")
+                self._cond.wait(remaining)
+
+        if p4 is None or not p4.connected() or p4.dropped():
+            # New slot or a connection the server dropped while idle
+            try:
+                self._disconnect(p4)
+                p4 = self.connect()
+            except:
+                self._release()
+                raise
+        with self._cond:
+            self._checkedOut[id(p4)] = generation
+        return p4
+
+    def checkin(self, p4, discard=False):
+        """
+        Give a connection back. Dropped connections, connections from before the last clear()
+        and connections given back with discard=True are closed instead of reused.
+        """
+        reuse = not discard and p4.connected() and not p4.dropped()
+        with self._cond:
+            generation = self._checkedOut.pop(id(p4), None)
+            if reuse and not self._closed and generation == self._generation:
+                self._idle.append(p4)
+                self._cond.notify()
+                return
+        self._disconnect(p4)
+        self._release()
+
+    @contextmanager
+    def connection(self, timeout=None, **kargs):
+        """Check out a connection for the with block, keyword arguments are set on it like P4.saved_context"""
+        p4 = self.checkout(timeout)
+        try:
+            with p4.saved_context(**kargs):
+                yield p4
+        finally:
+            self.checkin(p4)
+
+    def clear(self):
+        """
+        Close the idle connections, for example after the settings changed.
+        Connections that are checked out are closed once they come back.
+        """
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for p4 in idle:
+            self._disconnect(p4)
+
+    def close(self):
+        """Close the idle connections and those checked out once they come back"""
+        with self._cond:
+            self._closed = True
+        self.clear()
+
+    def _release(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def _disconnect(self, p4):
+        try:
+            if p4 is not None and p4.connected():
+                p4.disconnect()
+        except P4.P4Exception as why:
+            logger.debug(why)
@@ -0,0 +1,195 @@
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import platform
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+# Buffer used when a file has to be copied byte by byte
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Threads used to copy the files of multi-file outputs
+COPY_WORKERS = 4
+
+# Linux ioctl to share the extents of one file with another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def removeFile(filepath):
+    try:
+        os.remove(filepath)
+    except:
+        p = subprocess.Popen(["powershell","-WindowStyle", "Hidden", "-ExecutionPolicy", "ByPass", "-Command", "Remove-Item", "-Force", filepath], shell=True)
+        p.communicate()
+
+
+def replaceFile(src, dst):
+    """Atomically move src over dst, read-only targets are removed first"""
+    try:
+        if sys.version[0] == "3":
+            os.replace(src, dst)
+        elif platform.system() == "Windows" and os.path.exists(dst):
+            raise OSError("Can't rename over an existing file")
+        else:
+            os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        removeFile(dst)
+        os.rename(src, dst)
+
+
+def isSameFilesystem(src, dst):
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    except OSError:
+        return False
+
+
+def reflinkFile(src, dst):
+    """Create dst as a copy-on-write clone of src. Returns False where cloning isn't supported."""
+    system = platform.system()
+    if system == "Linux":
+        import fcntl
+        with open(src, "rb") as fsrc:
+            with open(dst, "wb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return True
+                except (IOError, OSError):
+                    pass
+        os.remove(dst)
+        return False
+    elif system == "Darwin":
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "clonefile"):
+            return False
+        encoding = sys.getfilesystemencoding()
+        return libc.clonefile(src.encode(encoding), dst.encode(encoding), 0) == 0
+    return False
+
+
+def copyFile(src, dst, callback=None, digest=False):
+    """
+    Copy src to dst in COPY_BUFFER_SIZE chunks, callback gets the number of bytes copied so far.
+    With digest the MD5 of the data is computed on the way and returned in the uppercase hex
+    form 'p4 fstat -Ol' reports.
+    """
+    md5 = hashlib.md5() if digest else None
+    copied = 0
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            while True:
+                buf = fsrc.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                fdst.write(buf)
+                if md5:
+                    md5.update(buf)
+                copied += len(buf)
+                if callback:
+                    callback(copied)
+    shutil.copymode(src, dst)
+    if md5:
+        return md5.hexdigest().upper()
+
+
+def stageFile(src, dst, callback=None):
+    """
+    Put src at dst without writing the data twice when possible.
+
+    On the same filesystem dst becomes a copy-on-write clone of src where the filesystem
+    supports it, otherwise the file is copied in large chunks. Never a hardlink: p4 edit,
+    sync or a save through the workspace path would change the published source too.
+    The result is first created next to dst and then swapped in atomically.
+    Returns "reflink" or "copy".
+    """
+    tmp = "{}.p4stage".format(dst)
+    if os.path.exists(tmp):
+        removeFile(tmp)
+
+    method = None
+    if isSameFilesystem(src, dst):
+        try:
+            if reflinkFile(src, tmp):
+                method = "reflink"
+        except (IOError, OSError) as why:
+            logger.debug("Can't clone {}. {}".format(src, why))
+
+    if not method:
+        copyFile(src, tmp, callback)
+        method = "copy"
+
+    try:
+        replaceFile(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            removeFile(tmp)
+        raise
+    return method
+
+
+def runParallel(func, items, workers=COPY_WORKERS, callback=None):
+    """
+    Call func(item) for every item on up to workers threads and return the results in item order.
+    callback gets the number of finished items and is called from the worker threads.
+    The first exception is raised again once all threads have stopped.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if len(items) < 2 or workers < 2:
+        for index, item in enumerate(items):
+            results[index] = func(item)
+            if callback:
+                callback(index + 1)
+        return results
+
+    todo = queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+    errors = []
+    lock = threading.Lock()
+    done = [0]
+
+    def work():
+        while not errors:
+            try:
+                index, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as why:
+                errors.append(why)
+                return
+            with lock:
+                done[0] += 1
+                count = done[0]
+            if callback:
+                callback(count)
+
+    threads = [threading.Thread(target=work, name="P4Copy") for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def stageFiles(files, workers=COPY_WORKERS, callback=None):
+    """stageFile for (src, dst) pairs in parallel, returns the staging methods in the same order"""
+    return runParallel(lambda pair: stageFile(pair[0], pair[1]), files, workers, callback)
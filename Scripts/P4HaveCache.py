@@ -0,0 +1,90 @@
+import time
+import logging
+import threading
+
+import P4
+
+logger = logging.getLogger(__name__)
+
+
+class HaveListCache(object):
+    """
+    Local copy of the have and head revisions of the depot files the plugin imports.
+
+    Entries come from a single 'fstat -T haveRev,headRev' for all files that aren't
+    known yet or were checked more than TTL seconds ago, and are updated from the
+    output of every sync. Files whose have revision is the head revision don't need
+    to be synced, so repeated imports of current files never reach the server.
+    """
+    # Seconds an entry is trusted before the server is asked again
+    TTL = 30
+
+    def __init__(self, ttl=None):
+        self.ttl = self.TTL if ttl is None else ttl
+        self._key = None
+        self._caseInsensitive = False
+        self._revs = {}
+        self._lock = threading.RLock()
+
+    def invalidate(self, depotFiles=None):
+        with self._lock:
+            if depotFiles is None:
+                self._revs.clear()
+                return
+            for depotFile in depotFiles:
+                self._revs.pop(self._normalize(depotFile), None)
+
+    def outdated(self, p4, depotFiles):
+        """Return the depotFiles that have a newer (or deleted) head revision than the workspace"""
+        now = time.time()
+        with self._lock:
+            self._checkKey(p4)
+            expired = []
+            for depotFile in depotFiles:
+                entry = self._revs.get(self._normalize(depotFile))
+                if not entry or now - entry[2] >= self.ttl:
+                    expired.append(depotFile)
+
+        if expired:
+            # Files not in the depot are only reported as warnings
+            with p4.at_exception_level(P4.P4.RAISE_ERRORS):
+                stats = p4.run_fstat("-T", "depotFile,haveRev,headRev,headAction", expired)
+            with self._lock:
+                # Only known for sure once the connection ran a command
+                self._caseInsensitive = p4.server_case_insensitive
+                for stat in stats:
+                    if not isinstance(stat, dict) or not stat.get("depotFile"):
+                        continue
+                    headRev = int(stat.get("headRev", 0))
+                    if "delete" in stat.get("headAction", ""):
+                        headRev = 0
+                    self._revs[self._normalize(stat["depotFile"])] = (int(stat.get("haveRev", 0)), headRev, now)
+            logger.debug("Checked the have revision of {} files".format(len(expired)))
+
+        result = []
+        with self._lock:
+            for depotFile in depotFiles:
+                entry = self._revs.get(self._normalize(depotFile))
+                if entry and entry[0] != entry[1]:
+                    result.append(depotFile)
+        return result
+
+    def synced(self, records):
+        """Update the entries from the output of run_sync"""
+        now = time.time()
+        with self._lock:
+            for record in records:
+                if not isinstance(record, dict) or not record.get("depotFile"):
+                    continue
+                rev = 0 if record.get("action") == "deleted" else int(record.get("rev", 0))
+                self._revs[self._normalize(record["depotFile"])] = (rev, rev, now)
+
+    def _checkKey(self, p4):
+        key = (p4.port, p4.client)
+        if key != self._key:
+            self._revs.clear()
+            self._caseInsensitive = p4.server_case_insensitive
+            self._key = key
+
+    def _normalize(self, depotFile):
+        return depotFile.lower() if self._caseInsensitive else depotFile
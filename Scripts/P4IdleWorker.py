@@ -0,0 +1,60 @@
+import logging
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+class P4IdleWorker(object):
+    """
+    Calls handle(item) for the items put into a queue, on a background thread that is
+    started on demand. The thread ends once no item came for IDLE_TIMEOUT seconds and
+    the next put() starts a new one, so an idle DCC keeps no thread around.
+
+    Exceptions from handle() are logged and the next item is served.
+    """
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, handle, name, items=None, idleTimeout=None):
+        self.handle = handle
+        self.name = name
+        # Any queue with put, get(timeout) and empty
+        self.items = queue.Queue() if items is None else items
+        self.idleTimeout = idleTimeout or self.IDLE_TIMEOUT
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        self.items.put(item)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def isRunning(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def _work(self):
+        while True:
+            try:
+                item = self.items.get(timeout=self.idleTimeout)
+            except queue.Empty:
+                with self._lock:
+                    # An item put before the lock was taken is served by this thread,
+                    # one put after it starts a new thread
+                    if self.items.empty():
+                        self._thread = None
+                        return
+                continue
+
+            try:
+                self.handle(item)
+            except Exception:
+                logger.error(traceback.format_exc())
@@ -0,0 +1,81 @@
+import random
+import logging
+import threading
+
+try:
+    from PySide2.QtCore import *
+except:
+    from PySide.QtCore import *
+
+import P4
+
+logger = logging.getLogger(__name__)
+
+
+class P4ReconnectScheduler(QObject):
+    """
+    Retries a connect function on a worker thread with exponential backoff and full jitter.
+
+    stateChanged is emitted with CONNECTING, CONNECTED or OFFLINE and finished with the final result,
+    both from the worker thread, so connect them with Qt.QueuedConnection when touching widgets.
+    """
+    CONNECTING, CONNECTED, OFFLINE = "connecting", "connected", "offline"
+
+    stateChanged = Signal(str)
+    finished = Signal(bool)
+
+    def __init__(self, baseDelay=0.5, maxDelay=30.0, parent=None):
+        super(P4ReconnectScheduler, self).__init__(parent)
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.state = self.OFFLINE
+        self._thread = None
+        self._cancel = threading.Event()
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, connect, retries=3):
+        """
+        Run connect() until it stops raising P4.P4Exception or retries are exhausted.
+        Returns False if a reconnect is already in progress.
+        """
+        if self.isRunning():
+            return False
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(connect, retries), name="P4Reconnect")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _setState(self, state):
+        self.state = state
+        self.stateChanged.emit(state)
+
+    def _run(self, connect, retries):
+        self._setState(self.CONNECTING)
+        connected = False
+        try:
+            delay = self.baseDelay
+            for attempt in range(retries + 1):
+                try:
+                    connect()
+                except P4.P4Exception as why:
+                    logger.warning("Perforce connection attempt {} failed. {}".format(attempt + 1, why))
+                else:
+                    connected = True
+                    return
+
+                if attempt == retries or self._cancel.wait(random.uniform(0, delay)):
+                    break
+                delay = min(self.maxDelay, delay * 2)
+        except Exception:
+            # Anything but a P4Exception is a bug, retrying won't help
+            logger.exception("Perforce connection attempt failed")
+        finally:
+            # Always report a final state, the widget and the callbacks wait for it
+            self._setState(self.CONNECTED if connected else self.OFFLINE)
+            self.finished.emit(connected)
@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+
+import P4
+
+logger = logging.getLogger(__name__)
+
+
+class WhereResolver(object):
+    """
+    In-process replacement for 'p4 where'.
+
+    The client spec View and Root are fetched once and turned into P4.Map objects,
+    so depot, client and local paths translate without a server round-trip.
+    The spec is fetched again after CHECK_INTERVAL seconds and the maps are only
+    rebuilt when it changed. Paths the maps can't translate fall back to run_where.
+    """
+    # Seconds before the client spec is fetched again to see if it changed
+    CHECK_INTERVAL = 60
+
+    def __init__(self, checkInterval=None):
+        self.checkInterval = self.CHECK_INTERVAL if checkInterval is None else checkInterval
+        self._key = None
+        self._update = None
+        self._checkedAt = 0
+        self._clientPrefix = None
+        self._depotToClient = None
+        self._depotToLocal = None
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+
+    def where(self, p4, path):
+        """
+        Resolve path (depot, client or local syntax) and return a dict with the same
+        depotFile, clientFile and path keys as run_where.
+        """
+        with self._lock:
+            self._refresh(p4)
+            result = self._translate(path)
+        if result:
+            return result
+
+        logger.debug("{} not resolved from the client view, asking the server".format(path))
+        return p4.run_where(path)[0]
+
+    def whereMany(self, p4, paths):
+        """
+        Resolve several paths at once. Anything the client view can't translate is sent
+        to the server in a single run_where call. Returns a dict of path to where result,
+        paths that aren't mapped at all are left out.
+        """
+        results = {}
+        misses = []
+        with self._lock:
+            self._refresh(p4)
+            for path in paths:
+                result = self._translate(path)
+                if result:
+                    results[path] = result
+                else:
+                    misses.append(path)
+        if not misses:
+            return results
+
+        # Unmapped files are reported as warnings, which only drops them from the output
+        with p4.at_exception_level(P4.P4.RAISE_ERRORS):
+            records = p4.run_where(misses)
+        for record in records:
+            if not isinstance(record, dict):
+                continue
+            for path in misses:
+                if path in (record.get("depotFile"), record.get("clientFile")) \
+                        or os.path.normpath(path) == os.path.normpath(record.get("path", "")):
+                    results[path] = record
+        return results
+
+    def _refresh(self, p4):
+        key = (p4.port, p4.client)
+        now = time.time()
+        if key == self._key and now - self._checkedAt < self.checkInterval:
+            return
+
+        spec = p4.fetch_client(p4.client)
+        self._checkedAt = now
+        if key == self._key and spec.get("Update") == self._update:
+            return
+
+        root = spec.get("Root", "").replace("\\", "/").rstrip("/")
+        self._clientPrefix = "//{}/".format(p4.client)
+        self._depotToClient = P4.Map(spec.get("View", []))
+        clientToLocal = P4.Map("{}...".format(self._clientPrefix), "{}/...".format(root))
+        self._depotToLocal = P4.Map.join(self._depotToClient, clientToLocal)
+        self._update = spec.get("Update")
+        self._key = key
+        logger.debug("Built client view map for {}".format(p4.client))
+
+    def _translate(self, path):
+        path = path.strip()
+        if path.startswith(self._clientPrefix):
+            depotFile = self._depotToClient.translate(path, P4.Map.RIGHT2LEFT)
+        elif path.startswith("//"):
+            depotFile = path
+        elif os.path.isabs(path):
+            depotFile = self._depotToLocal.translate(path.replace("\\", "/"), P4.Map.RIGHT2LEFT)
+        else:
+            # Relative paths depend on the connection's cwd, leave those to the server
+            return None
+        if not depotFile:
+            return None
+
+        clientFile = self._depotToClient.translate(depotFile)
+        localFile = self._depotToLocal.translate(depotFile)
+        if not clientFile or not localFile:
+            return None
+        return {"depotFile": depotFile, "clientFile": clientFile, "path": os.path.normpath(localFile)}
@@ -32,10 +32,8 @@
 
 from ntpath import basename
 import os,sys
-import shutil
 import subprocess
 import logging 
-import time
 
 # logging.basicConfig(level=logging.INFO)
 try:
@@ -62,6 +60,13 @@ except:
     import P4
 
 import P4Publish
+from P4ConnectionManager import P4ConnectionManager
+from P4ReconnectScheduler import P4ReconnectScheduler
+from P4WhereResolver import WhereResolver
+from P4HaveCache import HaveListCache
+from P4ConfigCache import PerforceConfigCache
+from P4CheckinQueue import P4CheckinQueue
+import P4FileUtils
 
 logger = logging.getLogger(__name__)
 
@@ -94,12 +99,33 @@ def get_logger(logger_name,create_file=False, log_file="logfile.log"):
     log.addHandler(ch)
     return   log 
 class Prism_Perforce_Functions(object):
-    CONNECTED, DISCONNECTED = "P4 Connected", "P4 Disconnected"
+    CONNECTED, DISCONNECTED, CONNECTING = "P4 Connected", "P4 Disconnected", "P4 Connecting..."
+    # Milliseconds without new edits before a state's p4 path is resolved / queued config edits are written
+    DEBOUNCE_INTERVAL = 400
+    CONFIG_FLUSH_INTERVAL = 1500
 
     def __init__(self, core, plugin):
         self.core = core
         self.plugin = plugin
         self.p4 = P4.P4()
+        self.connections = P4ConnectionManager()
+        self.reconnectScheduler = P4ReconnectScheduler()
+        self.reconnectScheduler.stateChanged.connect(self.onReconnectStateChanged, Qt.QueuedConnection)
+        self.reconnectScheduler.finished.connect(self.onReconnectFinished, Qt.QueuedConnection)
+        self._reconnectCallbacks = []
+        # Set once the server was found unreachable, cleared by the next successful connect
+        self._offline = False
+        self.whereResolver = WhereResolver()
+        self.haveList = HaveListCache()
+        self._pendingImportStates = []
+        self.configCache = PerforceConfigCache(core)
+        self.configFlushTimer = QTimer()
+        self.configFlushTimer.setSingleShot(True)
+        self.configFlushTimer.timeout.connect(self.flushConfig)
+        self._debounced = {}
+        self.checkinQueue = P4CheckinQueue(self.runCheckin, connections=self.connections)
+        self.checkinQueue.progress.connect(self.onCheckinProgress, Qt.QueuedConnection)
+        self.checkinQueue.jobFinished.connect(self.onCheckinFinished, Qt.QueuedConnection)
         self.logger = get_logger(__name__, True, os.path.join(os.path.dirname(core.prismIni), "perforce_logging.log"))
 
     # if returns true, the plugin will be loaded by Prism
@@ -164,7 +190,7 @@ class Prism_Perforce_Functions(object):
             lambda x: self.prismSettings_p4Toggled(origin, x)
         )
         origin.bt_p4testconnection.clicked.connect(
-            lambda x: self.connectToPerforce(show_message=True)
+            lambda x: self.connectToPerforceAsync(force=True, callback=self.showConnectionResult)
         )
 
     @err_catcher(name=__name__)
@@ -284,26 +310,42 @@ class Prism_Perforce_Functions(object):
             self._connected_widget = QCheckBox(Prism_Perforce_Functions.DISCONNECTED)
             # self._connected_widget.disable()
             self._connected_widget.setAutoFillBackground(True);
-            self._connected_widget.toggled.connect( lambda state: self.connectToPerforce())
+            self._connected_widget.clicked.connect( lambda state: self.connectToPerforceAsync())
             self._connected_widget.setStyleSheet("background-color:yellow; color:black")
         return self._connected_widget
     
     @connectStatusWidget.setter
     def connectStatusWidget(self, value):
-        self._connected_widget.setChecked(value)
+        # value is either a bool or one of the P4ReconnectScheduler states
+        widget = self.connectStatusWidget
+        if value == P4ReconnectScheduler.CONNECTING:
+            widget.setText(Prism_Perforce_Functions.CONNECTING)
+            widget.setStyleSheet("background-color:orange; color:black")
+            return
+        value = value in (True, P4ReconnectScheduler.CONNECTED)
+        widget.setChecked(value)
         if value:
-            self._connected_widget.setText(Prism_Perforce_Functions.CONNECTED)
-            self._connected_widget.setStyleSheet("background-color:green; color:white")
+            widget.setText(Prism_Perforce_Functions.CONNECTED)
+            widget.setStyleSheet("background-color:green; color:white")
         else:
-            self._connected_widget.setText(Prism_Perforce_Functions.DISCONNECTED)
-            self._connected_widget.setStyleSheet("background-color:yellow; color:black")
-        return self._connected_widget 
+            widget.setText(Prism_Perforce_Functions.DISCONNECTED)
+            widget.setStyleSheet("background-color:yellow; color:black")
+
+    @property
+    def checkinProgressWidget(self):
+        if not hasattr(self, "_checkin_progress_widget"):
+            self._checkin_progress_widget = QProgressBar()
+            self._checkin_progress_widget.setMaximumWidth(300)
+            self._checkin_progress_widget.setTextVisible(True)
+            self._checkin_progress_widget.setVisible(False)
+        return self._checkin_progress_widget
 
     @err_catcher(name=__name__)
     def onProjectBrowserStartup(self, origin):
         if not origin.statusBar():
             origin.setStatusBar(QStatusBar())
         origin.statusBar().addWidget(self.connectStatusWidget)
+        origin.statusBar().addWidget(self.checkinProgressWidget)
 
     @err_catcher(name=__name__)
     def onProjectBrowserClose(self, origin):
@@ -319,11 +361,11 @@ class Prism_Perforce_Functions(object):
 
     @err_catcher(name=__name__)
     def onStateManagerOpen(self, origin):
-        pass
+        self.flushImportStates()
 
     @err_catcher(name=__name__)
     def onStateManagerClose(self, origin):
-        pass
+        self.flushPendingEdits()
 
     @err_catcher(name=__name__)
     def onSelectTaskOpen(self, origin):
@@ -355,12 +397,12 @@ class Prism_Perforce_Functions(object):
             state_layout = state.gb_export.layout()
             taskname = state.l_taskName.text()
             fileformat = state.cb_outType.currentText()
-            state.cb_outType.currentTextChanged.connect(lambda x: self.setP4StateExport(origin, state, stateData))
+            state.cb_outType.currentTextChanged.connect(lambda x: self.debounce((id(state), "export"), lambda: self.setP4StateExport(origin, state, stateData)))
             self.lb_PerforceExportPath = QLabel("Perforce Export Path:")
             self.le_PerforceExportPath = QLineEdit()
             self.chb_createInPerforce.layout().addWidget(self.lb_PerforceExportPath)    
             self.chb_createInPerforce.layout().addWidget(self.le_PerforceExportPath)
-            self.le_PerforceExportPath.editingFinished.connect(lambda x: self.setP4StateExport(origin, state, stateData, x))
+            self.le_PerforceExportPath.editingFinished.connect(lambda: self.debounce((id(state), "export"), lambda: self.setP4StateExport(origin, state, stateData)))
             # self.setP4StateExport(origin, state, stateData)
         elif hasattr(state, "gb_import"):
             state_type = "import"
@@ -374,9 +416,9 @@ class Prism_Perforce_Functions(object):
             self.chb_createInPerforce.layout().addWidget(self.le_PerforceImportPath)
             self.le_PerforceImportPath.setDisabled(True)
             self.le_PerforceImportPath.setEnabled(False)
-            self.preImport(state=state, scenefile=data.get("filename"), importfile=state.e_file.text())
-            state.e_file.editingFinished.connect(lambda : self.setP4StateImport(origin, state, stateData))
-            state.e_name.editingFinished.connect(lambda : self.setP4StateImport(origin, state, stateData))
+            self.queueImportState(state)
+            state.e_file.editingFinished.connect(lambda : self.debounce((id(state), "import"), lambda: self.setP4StateImport(origin, state, stateData)))
+            state.e_name.editingFinished.connect(lambda : self.debounce((id(state), "import"), lambda: self.setP4StateImport(origin, state, stateData)))
             # self.setP4StateImport(origin, state, stateData)
         
         # # Get config from P4V
@@ -485,7 +527,7 @@ class Prism_Perforce_Functions(object):
             entity_path = os.path.abspath(os.path.join(path, os.pardir, os.pardir, os.pardir))
             entity_path = self.core.convertPath(entity_path, "global")
             try:
-                p4path = self.p4.run_where(self.le_PerforcePath.text())[0].get("depotFile", "")
+                p4path = self.where(self.le_PerforcePath.text()).get("depotFile", "")
             except:
                 return
             else:
@@ -581,41 +623,22 @@ class Prism_Perforce_Functions(object):
 
     @err_catcher(name=__name__)
     def preImport(self, *args, **kwargs):
-        print(args, kwargs)
         if not self.isPluginActive():
             return kwargs
 
-        p4path = ""
-        data = self.core.entities.getScenefileData(self.core.getCurrentFileName())
-        entity_path = self.core.getEntityBasePath(data.get("filename"))
-        category = data.get("category")
         state = kwargs['state']
-        fileformat = os.path.splitext(kwargs["importfile"])[-1]
-
-        # Get config from P4V
         try:
-            p4path = self.getConfig(category,  self.core.convertPath(entity_path, target="global"))["import"][state.e_name.text()][fileformat]
+            p4path = self.getImportP4Path(state, kwargs["importfile"])
         except Exception as why:
             logger.error("Failed to resolve to p4path.")
             raise
         if hasattr(self, "le_PerforceImportPath"):
             self.le_PerforceImportPath.setText(p4path)
         if p4path:
-            self.connectToPerforce()
-            try:
-                self.p4.run_sync(p4path)
-            except P4.P4Exception as why:
-                if why.errors:
-                    logger.error(why.errors)
-                else:
-                    logger.info(why.warnings)
-
-            try:
-                kwargs["importfile"] = self.p4.run_where(p4path)[0].get("path", kwargs["importfile"])
-                state.e_file.setText(kwargs["importfile"])
-            except P4.P4Exception as why:
-                if why.errors:
-                    logger.error("{} import file in not map in p4, {}".format( p4path, why.errors))
+            importfile = self.syncImportPaths([p4path]).get(p4path)
+            if importfile:
+                kwargs["importfile"] = importfile
+                state.e_file.setText(importfile)
         return kwargs
 
     @err_catcher(name=__name__)
@@ -770,6 +793,85 @@ class Prism_Perforce_Functions(object):
 
     #P4 Function
 
+    def getImportP4Path(self, state, importfile):
+        """
+        Look up the p4 path configured for an import state.
+        Raises if the entity config has no entry for it.
+        """
+        data = self.core.entities.getScenefileData(self.core.getCurrentFileName())
+        entity_path = self.core.getEntityBasePath(data.get("filename"))
+        category = data.get("category")
+        fileformat = os.path.splitext(importfile)[-1]
+        return self.getConfig(category,  self.core.convertPath(entity_path, target="global"))["import"][state.e_name.text()][fileformat]
+
+    @err_catcher(name=__name__)
+    def queueImportState(self, state):
+        """
+        Collect import states while the StateManager loads them, so they can be synced in one batch.
+        The flush runs once control returns to the event loop, after all states of the scene were created.
+        """
+        if not self._pendingImportStates:
+            QTimer.singleShot(0, self.flushImportStates)
+        self._pendingImportStates.append(state)
+
+    @err_catcher(name=__name__)
+    def flushImportStates(self):
+        states, self._pendingImportStates = self._pendingImportStates, []
+        statePaths = []
+        for state in states:
+            try:
+                statePaths.append((state, self.getImportP4Path(state, state.e_file.text())))
+            except RuntimeError:
+                # State got deleted before the flush
+                continue
+            except Exception as why:
+                logger.debug("No p4 import path for state. {}".format(why))
+        if not statePaths:
+            return
+
+        resolved = self.syncImportPaths([p4path for state, p4path in statePaths])
+        for state, p4path in statePaths:
+            importfile = resolved.get(p4path)
+            if not importfile:
+                continue
+            try:
+                state.e_file.setText(importfile)
+            except RuntimeError:
+                pass
+
+    @err_catcher(name=__name__)
+    def syncImportPaths(self, p4paths):
+        """
+        Resolve p4paths with at most one 'p4 where' and sync the ones the have list shows as
+        outdated (or missing locally) with a single 'p4 sync'. Current files aren't synced at all.
+        Returns a dict of p4path to workspace path for every path that could be resolved.
+        """
+        p4paths = sorted(set(p for p in p4paths if p))
+        if not p4paths or not self.connectToPerforce():
+            return {}
+
+        resolved = self.whereResolver.whereMany(self.p4, p4paths)
+        for p4path in p4paths:
+            if p4path not in resolved:
+                logger.error("{} import file in not map in p4".format(p4path))
+        depotFiles = [result["depotFile"] for result in resolved.values()]
+        try:
+            outdated = self.haveList.outdated(self.p4, depotFiles)
+            # The have list says these are current, so only a forced sync brings them back
+            missing = [result["depotFile"] for result in resolved.values()
+                       if result["depotFile"] not in outdated and not os.path.exists(result["path"])]
+            # Up to date files only produce warnings, don't let them abort the batch
+            with self.p4.at_exception_level(P4.P4.RAISE_ERRORS):
+                if outdated:
+                    self.haveList.synced(self.p4.run_sync(outdated))
+                if missing:
+                    self.haveList.synced(self.p4.run_sync("-f", missing))
+        except P4.P4Exception as why:
+            logger.error(why.errors)
+            self.haveList.invalidate(depotFiles)
+
+        return dict((p4path, result.get("path")) for p4path, result in resolved.items())
+
     @err_catcher(name=__name__)
     def setP4StateImport(self, origin, state, stateData, p4path = ""):
         if not p4path:
@@ -779,12 +881,12 @@ class Prism_Perforce_Functions(object):
         p4path = self.preImport(state=state, scenefile=self.core.getCurrentFileName(), importfile=p4path)['importfile']
         # self.connectToPerforce()
         try:
-            resolve_p4path = self.p4.run_where(p4path)
+            resolve_p4path = self.where(p4path)
         except P4.P4Exception as why:
             QMessageBox.critical(self.core.messageParent, "Perforce Error", "{} is not valid P4 path. {}".format(p4path, why))
             raise
 
-        resolve_p4path = resolve_p4path[0].get("depotFile", "")
+        resolve_p4path = resolve_p4path.get("depotFile", "")
         if not resolve_p4path:
             logger.warn("{} is not a p4 file".format(p4path))
             return
@@ -799,7 +901,7 @@ class Prism_Perforce_Functions(object):
         category = data.get("category")
         
         entity_path = self.core.convertPath(entity_path, target="global")
-        self.setConfig({category: {"import":{taskname:{fileformat: resolve_p4path}}}}, entity_path)
+        self.queueConfig({category: {"import":{taskname:{fileformat: resolve_p4path}}}}, entity_path)
 
     @err_catcher(name=__name__)
     def setP4StateExport(self, origin, state, stateData, p4path = ""):
@@ -809,12 +911,12 @@ class Prism_Perforce_Functions(object):
             return
 
         try:
-            resolve_p4path = self.p4.run_where(p4path)
+            resolve_p4path = self.where(p4path)
         except P4.P4Exception as why:
             QMessageBox.critical(self.core.messageParent, "Perforce Error", "{} is not valid P4 path. {}".format(p4path, why))
             raise
 
-        resolve_p4path = resolve_p4path[0].get("depotFile", "")
+        resolve_p4path = resolve_p4path.get("depotFile", "")
         if not resolve_p4path:
             logger.warn("{} is not a p4 file".format(p4path))
             return
@@ -829,67 +931,156 @@ class Prism_Perforce_Functions(object):
         category = data.get("category")
         
         entity_path = self.core.convertPath(entity_path, target="global")
-        self.setConfig({category: {"export":{taskname:{fileformat: resolve_p4path}}}}, entity_path)
+        self.queueConfig({category: {"export":{taskname:{fileformat: resolve_p4path}}}}, entity_path)
 
     @err_catcher(name=__name__)
-    def connectToPerforce(self, retry=3, show_message=False):
-        # if (
-        #     not hasattr(self, "p4")
-        #     or not hasattr(self, "sgPrjId")
-        #     or (user and not hasattr(self, "sgUserId"))
-        # ):
-        is_connected_p4 = False
-        try:
-            self.p4.disconnect()
-        except:
-            pass
+    def getConnectionSettings(self):
         try:
-            self.p4.port = self.core.getConfig("perforce", "port", configPath = self.core.prismIni)
-            self.p4.user = self.core.getConfig("perforce", "p4username")
-            self.p4.client = self.core.getConfig("perforce", "p4userworkspacename")
-            self.p4.password = self.core.getConfig("perforce", "p4userpassword")
+            port = self.core.getConfig("perforce", "port", configPath = self.core.prismIni)
+            user = self.core.getConfig("perforce", "p4username")
+            client = self.core.getConfig("perforce", "p4userworkspacename")
+            password = self.core.getConfig("perforce", "p4userpassword")
         except AttributeError as why:
             logger.error(why)
             return
+        return port, user, client, password
+
+    @err_catcher(name=__name__)
+    def connectToPerforce(self, retry=3, show_message=False):
+        """
+        Make a single connection attempt on the calling thread and return the result.
+        The session is kept alive between calls and the login ticket is only re-checked once its cache expires.
+        If the server can't be reached, the retries run in the background and False is returned right away.
+        While the server is known to be unreachable, only an explicit attempt (show_message) blocks on it,
+        other calls return False at once and leave the retries to the background.
+        """
+        offline = self._offline or self.reconnectScheduler.isRunning()
+        if offline and not show_message and not self.p4.connected():
+            if retry and not self.reconnectScheduler.isRunning():
+                self.connectToPerforceAsync(retry=retry)
+            return False
+        settings = self.getConnectionSettings()
+        if not settings:
+            return
         try:
-            self.p4.connect()
-        except P4.P4Exception as why:
-            raise P4.P4Exception("Failed to connect to p4. {}".format(why))
-        try:
-            self.p4.run_login('-s')
-            is_connected_p4 = True
+            self.p4 = self.connections.connection(*settings, force=show_message)
         except P4.P4Exception as why:
+            logger.warning(why)
+            if show_message:
+                QMessageBox.critical(self.core.messageParent, "Perforce Error", "Failed to login to p4. {}".format(why))
+            self._offline = True
+            self.connectStatusWidget = False
+            if retry:
+                self.connectToPerforceAsync(retry=retry)
+            return False
+
+        if show_message:
+            self.showConnectionResult(True)
+        self._offline = False
+        self.connectStatusWidget = True
+        return True
+
+    @err_catcher(name=__name__)
+    def connectToPerforceAsync(self, retry=3, force=False, callback=None):
+        """
+        Check the server on a worker thread with exponential backoff, so the DCC never blocks on the server.
+        The worker probes with its own connection, self.p4 is (re)connected on the main thread once that succeeded.
+        callback gets called on the main thread with the final result.
+        """
+        settings = self.getConnectionSettings()
+        if not settings:
+            return
+        if callback:
+            self._reconnectCallbacks.append(callback)
+        self.reconnectScheduler.start(lambda: self.connections.probe(*settings, force=force), retries=retry)
+
+    @err_catcher(name=__name__)
+    def onReconnectStateChanged(self, state):
+        self.connectStatusWidget = state
+
+    @err_catcher(name=__name__)
+    def onReconnectFinished(self, is_connected_p4):
+        settings = self.getConnectionSettings()
+        if is_connected_p4 and settings:
+            # The worker's probe refreshed the cached login check, so this normally only reconnects
             try:
-                self.p4.run_login()
-                is_connected_p4 = True
+                self.p4 = self.connections.connection(*settings)
             except P4.P4Exception as why:
-                if show_message and retry == 0:
-                    QMessageBox.critical(self.core.messageParent, "Perforce Error", "Failed to login to p4. {}".format(why))
-        while not is_connected_p4 and retry != 0:
-            time.sleep(1)
-            is_connected_p4 = self.connectToPerforce(retry-1)
-        if show_message and is_connected_p4:
+                logger.warning(why)
+                is_connected_p4 = False
+                self.connectStatusWidget = False
+        self._offline = not is_connected_p4
+        callbacks, self._reconnectCallbacks = self._reconnectCallbacks, []
+        for callback in callbacks:
+            callback(is_connected_p4)
+
+    @err_catcher(name=__name__)
+    def showConnectionResult(self, is_connected_p4):
+        if is_connected_p4:
             QMessageBox.information(self.core.messageParent, "Perforce", "Successfully connect to {} with user {}".format(self.p4.port, self.p4.user))
-        
-        if hasattr(self, "connectStatusWidget"):
-            self.connectStatusWidget = is_connected_p4
+        else:
+            QMessageBox.critical(self.core.messageParent, "Perforce Error", "Failed to connect to p4 {}".format(self.p4.port))
 
-        return is_connected_p4
+    def where(self, path):
+        """
+        Same as self.p4.run_where(path)[0], but resolved from the cached client view when possible.
+        Not wrapped in err_catcher, callers handle P4.P4Exception themselves.
+        """
+        return self.whereResolver.where(self.p4, path)
 
     @err_catcher(name=__name__)
     def getConfigPath(self, rootPath):
-        return os.path.join(rootPath,"perforce.yml")
+        return self.configCache.getConfigPath(rootPath)
 
     @err_catcher(name=__name__)
     def getConfig(self, param, configRoot):
-        return self.core.getConfig("perforce", param, configPath=self.getConfigPath(configRoot))
+        return self.configCache.get(param, configRoot)
 
     @err_catcher(name=__name__)
     def setConfig(self, data, configRoot):
-        data = {'perforce':data}
-        self.core.setConfig(data=data, configPath=self.getConfigPath(configRoot))
-        self.core.configs.clearCache()
+        self.configCache.set(data, configRoot)
+
+
+    @err_catcher(name=__name__)
+    def queueConfig(self, data, configRoot):
+        """
+        Like setConfig, but edits are merged per file and written once no new edit arrived for CONFIG_FLUSH_INTERVAL
+        """
+        self.configCache.queue(data, configRoot)
+        self.configFlushTimer.start(self.CONFIG_FLUSH_INTERVAL)
+
+    @err_catcher(name=__name__)
+    def flushConfig(self):
+        self.configFlushTimer.stop()
+        if self.configCache.hasPending():
+            self.configCache.flush()
+
+    @err_catcher(name=__name__)
+    def debounce(self, key, func):
+        """
+        Call func once the calls for key stopped coming in for DEBOUNCE_INTERVAL, only the last func is called
+        """
+        if key not in self._debounced:
+            timer = QTimer()
+            timer.setSingleShot(True)
+            timer.timeout.connect(lambda: self._callDebounced(key))
+            self._debounced[key] = [timer, None]
+        self._debounced[key][1] = func
+        self._debounced[key][0].start(self.DEBOUNCE_INTERVAL)
 
+    @err_catcher(name=__name__)
+    def _callDebounced(self, key):
+        timer, func = self._debounced[key]
+        timer.stop()
+        if func:
+            self._debounced[key][1] = None
+            func()
+
+    @err_catcher(name=__name__)
+    def flushPendingEdits(self):
+        for key in list(self._debounced):
+            self._callDebounced(key)
+        self.flushConfig()
 
     @err_catcher(name=__name__)
     def openP4SetPathDialog(self, origin, filepath):
@@ -986,11 +1177,7 @@ class Prism_Perforce_Functions(object):
 
     @err_catcher(name=__name__)
     def os_removefile(self, filepath):
-        try:
-            os.remove(filepath)
-        except:
-            p = subprocess.Popen(["powershell","-WindowStyle", "Hidden", "-ExecutionPolicy", "ByPass", "-Command", "Remove-Item", "-Force", filepath], shell=True)
-            p.communicate()
+        P4FileUtils.removeFile(filepath)
 
     @err_catcher(name=__name__)
     def importFromP4(self, origin, filepath, p4path):
@@ -998,13 +1185,10 @@ class Prism_Perforce_Functions(object):
         cat = os.path.dirname(filepath)
         if not self.connectToPerforce(show_message=False):
             return
-        workspacep4path = self.p4.run_where(p4path)[0].get('path')
-        if not os.path.exists(workspacep4path):
-            try:
-                self.p4.run_sync(p4path)
-            except P4.P4Exception as why:
-                QMessageBox.critical(self.core.messageParent, "Perforce Error", "{} is not exists or cannot be sync.{}".format(p4path, why))
-                raise
+        workspacep4path = self.syncImportPaths([p4path]).get(p4path)
+        if not workspacep4path or not os.path.exists(workspacep4path):
+            QMessageBox.critical(self.core.messageParent, "Perforce Error", "{} is not exists or cannot be sync.".format(p4path))
+            return
         try:
             dstfilepath = self.core.generateScenePath(
                 entity=fnameData["entity"],
@@ -1015,7 +1199,10 @@ class Prism_Perforce_Functions(object):
                 basePath=self.core.paths.getEntityBasePath(filepath),
                 extension=fnameData["extension"],
             )
-            shutil.copyfile(workspacep4path, dstfilepath)
+            digest = P4FileUtils.copyFile(workspacep4path, dstfilepath, digest=True)
+            if not self.isDigestValid(p4path, digest):
+                P4FileUtils.removeFile(dstfilepath)
+                raise IOError("{} doesn't match the depot revision, force sync it and import again".format(workspacep4path))
         except:
             QMessageBox.critical(self.core.messageParent, "Perforce", "Failed to import p4 file {}".format(p4path))
             raise
@@ -1030,6 +1217,18 @@ class Prism_Perforce_Functions(object):
             self.core.pb.refreshUI()
         QMessageBox.information(self.core.messageParent, "Perforce", "Successfully import p4 file {}".format(p4path))
 
+    def isDigestValid(self, p4path, digest):
+        """
+        Compare the MD5 computed while copying a workspace file with the digest of its synced revision.
+        Only binary files are checked, the server normalizes line endings of text files before hashing.
+        """
+        with self.p4.at_exception_level(P4.P4.RAISE_ERRORS):
+            stats = self.p4.run_fstat("-Ol", "-T", "headType,digest,action", "{}#have".format(p4path))
+        stat = stats[0] if stats and isinstance(stats[0], dict) else {}
+        if stat.get("action") or "binary" not in stat.get("headType", "") or not stat.get("digest"):
+            return True
+        return stat["digest"].upper() == digest
+
     @err_catcher(name=__name__)
     def openInP4V(self, filepath = ""):
         rawpath, ext = os.path.splitext(filepath)
@@ -1045,8 +1244,14 @@ class Prism_Perforce_Functions(object):
         subprocess.Popen(cmd)
 
     @err_catcher(name=__name__)
-    def checkinP4(self, filepath, p4path=""):
-        if not self.connectToPerforce(show_message=False):
+    def checkinP4(self, filepath, p4path="", reconcile=False):
+        """
+        Queue filepath to be copied into the workspace and opened in p4.
+        The work runs on the check-in thread, the result is shown in a non-modal notification.
+        Files are opened with a targeted add/edit, reconcile=True scans the destination with 'p4 reconcile' instead.
+        """
+        settings = self.getConnectionSettings()
+        if not settings:
             return
         if not p4path:
             rawpath, ext = os.path.splitext(filepath)
@@ -1058,30 +1263,116 @@ class Prism_Perforce_Functions(object):
                 p4path = p4path.get(ext)
         if not p4path:
             return
-        try:
-            p4path = self.p4.run_where(p4path)[0].get("path")
-        except P4.P4Exception as why:    
-            self.logger.error("Failed to resolve {} to p4 path.\n {}".format(p4path, why))
-            return
-        
-        try:
-            os.makedirs(os.path.dirname(p4path))
-        except:
-            pass
+        return self.checkinQueue.put(filepath, p4path, settings, reconcile=reconcile)
 
+    def runCheckin(self, p4, job, progress):
+        """
+        Does the check-in of one P4CheckinQueue job. Runs on the check-in thread with its own
+        connection, so it must not touch widgets or self.p4. Raises on failure.
+        """
+        progress.setDescription("Resolving {}".format(job.p4path), P4.Progress.UNIT_PERCENT)
         try:
-            if os.path.exists(p4path):
-                self.os_removefile(p4path)
-        except Exception as why:
-            logger.error("Encountered issue remove {}.\n{}".format(p4path, why))
+            p4path = self.whereResolver.where(p4, job.p4path).get("path")
+        except P4.P4Exception as why:
+            raise P4.P4Exception("Failed to resolve {} to p4 path.\n {}".format(job.p4path, why))
+        job.workspacePath = p4path
+
+        # Directory outputs (image sequences, USD layers...) are checked in file by file
+        if os.path.isdir(job.filepath):
+            files = []
+            for root, dirnames, filenames in os.walk(job.filepath):
+                for filename in filenames:
+                    src = os.path.join(root, filename)
+                    files.append((src, os.path.join(p4path, os.path.relpath(src, job.filepath))))
+        else:
+            files = [(job.filepath, p4path)]
+        dstFiles = [dst for src, dst in files]
+
+        if job.reconcile:
+            toEdit, toAdd = [], []
         else:
+            toEdit, toAdd, toSync, toReopen = self.classifyCheckinFiles(p4, dstFiles)
+            if toSync:
+                # In the depot but not on this client, edit needs a have revision
+                p4.run_sync("-k", toSync, progress=progress, handler=progress)
+            if toReopen:
+                # Opened for delete, the new content replaces the delete
+                p4.run_revert("-k", toReopen, progress=progress, handler=progress)
+            if toEdit:
+                # Open before copying, so the read-only workspace files become writable
+                p4.run_edit(toEdit, progress=progress, handler=progress)
+
+        progress.setDescription("Copying {}".format(os.path.basename(job.filepath)), P4.Progress.UNIT_FILES)
+        progress.setTotal(len(files))
+        for dirname in set(os.path.dirname(dst) for dst in dstFiles):
             try:
-                shutil.copy(filepath, p4path)
-                self.p4.run_reconcile(p4path)
-            except P4.P4Exception as why:
-                logger.error("Failed to check in {} to self.P4. \n {}".format(p4path, why))
+                os.makedirs(dirname)
+            except:
+                pass
+        methods = P4FileUtils.stageFiles(files, callback=progress.update)
+        logger.debug("Staged {} files to {} ({})".format(len(files), p4path, ", ".join(sorted(set(methods)))))
+
+        progress.setDescription("Opening {} in p4".format(os.path.basename(p4path)), P4.Progress.UNIT_PERCENT)
+        if job.reconcile:
+            target = os.path.join(p4path, "...") if os.path.isdir(job.filepath) else p4path
+            p4.run_reconcile(target, progress=progress, handler=progress)
+        elif toAdd:
+            p4.run_add(toAdd, progress=progress, handler=progress)
+        logger.info("Interate {} to P4 success. Please check your pending changelist.".format(p4path))
+
+    def classifyCheckinFiles(self, p4, files):
+        """
+        Split workspace files into the ones to 'p4 edit' and the ones to 'p4 add' with a single fstat.
+        Returns toEdit, toAdd, toSync and toReopen. toSync are files to edit that aren't in the have list
+        yet and need a 'sync -k' first. toReopen are files opened for delete, which are reverted with -k
+        and then edited. Files already opened otherwise need nothing.
+        """
+        # Files that were never submitted are only reported as warnings
+        with p4.at_exception_level(P4.P4.RAISE_ERRORS):
+            stats = p4.run_fstat("-T", "clientFile,headAction,haveRev,action", files)
+        known = {}
+        for stat in stats:
+            if isinstance(stat, dict) and stat.get("clientFile"):
+                known[os.path.normcase(os.path.normpath(stat["clientFile"]))] = stat
+
+        toEdit, toAdd, toSync, toReopen = [], [], [], []
+        for filepath in files:
+            stat = known.get(os.path.normcase(os.path.normpath(filepath)))
+            if stat and stat.get("action") == "delete":
+                toReopen.append(filepath)
+                toEdit.append(filepath)
+            elif stat and stat.get("action"):
+                continue
+            elif stat and stat.get("headAction") and "delete" not in stat["headAction"]:
+                if not stat.get("haveRev"):
+                    toSync.append(filepath)
+                toEdit.append(filepath)
             else:
-                logger.info("Interate {} to P4 success. Please check your pending changelist.".format(p4path))
-        QMessageBox.information(self.core.messageParent, "Perforce", "Successfully check in {} .Please check your pending changelist.".format(p4path))
-        subprocess.Popen(["p4v", "-p", self.p4.port, "-u", self.p4.user, "-c", self.p4.client ])
-        return p4path
+                toAdd.append(filepath)
+        return toEdit, toAdd, toSync, toReopen
+
+    @err_catcher(name=__name__)
+    def onCheckinProgress(self, filepath, description, position, total):
+        widget = self.checkinProgressWidget
+        widget.setVisible(True)
+        widget.setMaximum(total or 100)
+        widget.setValue(position)
+        pending = self.checkinQueue.pending()
+        widget.setFormat("{} ({} queued)".format(description, pending) if pending else description)
+
+    @err_catcher(name=__name__)
+    def onCheckinFinished(self, job):
+        if not self.checkinQueue.pending():
+            self.checkinProgressWidget.setVisible(False)
+
+        if job.error:
+            self.logger.error("Failed to check in {} to P4. \n {}".format(job.filepath, job.error))
+            msg = QMessageBox(QMessageBox.Warning, "Perforce", "Failed to check in {}.\n{}".format(job.filepath, job.error), parent=self.core.messageParent)
+        else:
+            msg = QMessageBox(QMessageBox.Information, "Perforce", "Successfully check in {} .Please check your pending changelist.".format(job.workspacePath), parent=self.core.messageParent)
+            b_p4v = msg.addButton("Open in P4V", QMessageBox.ActionRole)
+            b_p4v.clicked.connect(lambda: subprocess.Popen(["p4v", "-p", self.p4.port, "-u", self.p4.user, "-c", self.p4.client, "-s", job.p4path]))
+        msg.addButton(QMessageBox.Ok)
+        msg.setModal(False)
+        msg.setAttribute(Qt.WA_DeleteOnClose)
+        msg.show()
@@ -1,43 +1,102 @@
 import os
+import itertools
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from P4 import P4, P4Exception
 from qtpy import QtCore, QtGui, QtWidgets
 
 import perforce.Utils as Utils
 from perforce.AppInterop import interop
+from perforce.PerforceUtils import SetupConnection, FstatFilter
+from perforce.PerforceUtils.IdleWorker import IdleWorker
 
 def epochToTimeStr(time):
     import datetime
     return datetime.datetime.utcfromtimestamp(int(time)).strftime("%d/%m/%Y %H:%M:%S")
 
+try:
+    intern
+except NameError:
+    from sys import intern
+
+def internString(value):
+    # Unicode strings can't be interned on Python 2
+    try:
+        return intern(value)
+    except TypeError:
+        return value
+
 class PerforceItem(object):
+    '''
+    Node of the depot/client tree. Large folders hold tens of thousands of these,
+    so they use slots, know their own row and share the repeated type/action strings.
+    '''
+    __slots__ = ('parentItem', 'childItems', 'rowIndex', 'loadState',
+                 'name', 'fileType', 'time', 'action', 'change', 'path')
+
+    # Whether the children of a folder were listed yet
+    UNLOADED, LOADING, LOADED = range(3)
+
+    COLUMNS = ('name', 'fileType', 'time', 'action', 'change', 'path')
+
+    # Type of the row that loads the next page of a folder
+    MORE_TYPE = 'More'
+    MORE_LABEL = 'Load more...'
 
     def __init__(self, data, parent=None):
         self.parentItem = parent
-        self.data = data
-        self.childItems = []
+        self.rowIndex = 0
+        if data is None:
+            self.name = self.fileType = self.time = self.action = self.change = self.path = None
+        else:
+            self.name, fileType, self.time, action, self.change, self.path = data
+            self.fileType = internString(fileType)
+            self.action = internString(action)
 
-    def appendFileItem(self, filepath, filetype, time, action, change):
-        fileName = os.path.basename(filepath)
+        if self.isFolder():
+            self.childItems = []
+            self.loadState = PerforceItem.UNLOADED
+        else:
+            # Files never get children, share one empty tuple
+            self.childItems = ()
+            self.loadState = PerforceItem.LOADED
 
+    @property
+    def data(self):
         # Kludge to pass through the raw path as an extra column that simply isn't used
-        data = (fileName, filetype, time, action, change, filepath)
+        if self.name is None:
+            return None
+        return (self.name, self.fileType, self.time, self.action, self.change, self.path)
+
+    def column(self, column):
+        return getattr(self, PerforceItem.COLUMNS[column])
+
+    def isFolder(self):
+        # The root item has no data
+        return self.fileType is None or self.fileType == 'Folder'
 
-        fileItem = PerforceItem(data, self)
-        self.appendChild(fileItem)
+    def appendFileItem(self, filepath, filetype, time, action, change):
+        fileName = os.path.basename(filepath)
+        self.appendChild(PerforceItem((fileName, filetype, time, action, change, filepath), self))
 
     def appendFolderItem(self, dirpath):
         dirName = os.path.basename(dirpath)
+        self.appendChild(PerforceItem((dirName, 'Folder', '', '', '', dirpath), self))
 
-        # Kludge to pass through the raw path as an extra column that simply isn't used
-        data = (dirName, 'Folder', '', '', '', dirpath)
-
-        fileItem = PerforceItem(data, self)
-        self.appendChild(fileItem)
-        fileItem.appendChild(None)
+    def appendMoreItem(self, lastDepotFile):
+        # The last listed depot file is where the next page continues
+        self.appendChild(PerforceItem((PerforceItem.MORE_LABEL, PerforceItem.MORE_TYPE, '', '', '', lastDepotFile), self))
 
+    def isMoreItem(self):
+        return self.fileType == PerforceItem.MORE_TYPE
 
     def appendChild(self, item):
+        item.rowIndex = len(self.childItems)
         self.childItems.append(item)
 
     def popChild(self):
@@ -45,9 +104,7 @@ class PerforceItem(object):
             self.childItems.pop()
 
     def row(self):
-        if self.parentItem:
-            return self.parentItem.childItems.index(self)
-        return 0
+        return self.rowIndex
 
     @staticmethod
     def absoluteP4Path(idx):
@@ -62,117 +119,337 @@ class PerforceItem(object):
 
         return list(reversed(result))
 
+class OpenedFilesIndex(object):
+    '''
+    Prefix tree of the files opened in the current workspace, keyed by client path.
+    Built from a single 'p4 opened', it tells which subfolders of a folder hold pending
+    files without asking the server again.
+    '''
+    def __init__(self, client, clientRoot, clientFiles, caseInsensitive=False):
+        self.clientPrefix = "//{0}/".format(client)
+        self.clientRoot = clientRoot.replace('\\', '/').rstrip('/') + '/'
+        self.caseInsensitive = caseInsensitive
+        self.tree = {}
+
+        for clientFile in clientFiles:
+            if not clientFile.startswith(self.clientPrefix):
+                continue
+            node = self.tree
+            for name in clientFile[len(self.clientPrefix):].split('/')[:-1]:
+                node = node.setdefault(self._key(name), (name, {}))[1]
+
+    @classmethod
+    def fromConnection(cls, p4):
+        with p4.at_exception_level(P4.RAISE_ERRORS):
+            opened = p4.run_opened(records=True)
+            clientRoot = p4.run_info()[0]['clientRoot']
+        # Deleted files aren't shown in the client view
+        clientFiles = [ f['clientFile'] for f in opened if f.get('action') not in ['delete','move/delete'] ]
+        Utils.p4Logger().debug('Indexed %d opened files' % len(clientFiles))
+        return cls(p4.client, clientRoot, clientFiles, p4.server_case_insensitive)
+
+    def _key(self, name):
+        return name.lower() if self.caseInsensitive else name
+
+    def toClientPath(self, path):
+        '''Convert a client or local folder path to client syntax, None if it isn't in the workspace'''
+        path = path.replace('\\', '/').rstrip('/') + '/'
+        if path.startswith('//'):
+            return path if self._key(path).startswith(self._key(self.clientPrefix)) else None
+        if self._key(path).startswith(self._key(self.clientRoot)):
+            return self.clientPrefix + path[len(self.clientRoot):]
+        return None
+
+    def childFolders(self, clientDir):
+        '''Names of the subfolders of clientDir that contain opened files'''
+        if not clientDir:
+            return []
+        node = self.tree
+        for name in clientDir[len(self.clientPrefix):].split('/'):
+            if not name:
+                continue
+            child = node.get(self._key(name))
+            if child is None:
+                return []
+            node = child[1]
+        return [ name for name, children in node.values() ]
+
+class FstatWorker(QtCore.QObject):
+    '''
+    Lists folders for a PerforceItemModel on a background thread, with a connection
+    checked out from the pool shared by the windows.
+    Requests with a lower priority value are served first, so folders the user expands
+    jump ahead of prefetches. The signals are emitted from the worker thread.
+    '''
+    loaded = QtCore.Signal(object, object)
+    failed = QtCore.Signal(object, object)
+
+    def __init__(self, p4, listDir, parent=None):
+        super(FstatWorker, self).__init__(parent)
+
+        self.p4 = p4
+        self.listDir = listDir
+        self.pool = SetupConnection.connectionPool(p4)
+        self._counter = itertools.count()
+        self._worker = IdleWorker(self._list, "P4Fstat", queue.PriorityQueue())
+
+    def request(self, item, args, priority=0):
+        self._worker.put((priority, next(self._counter), item, args))
+
+    def _list(self, request):
+        priority, count, item, args = request
+        try:
+            with self.pool.connection() as p4:
+                folders, files, lastDepotFile = self.listDir(p4, *args)
+        except Exception as e:
+            self.failed.emit(item, e)
+            return
+        self.loaded.emit(item, (folders, files, lastDepotFile, priority))
+
 class PerforceItemModel(QtCore.QAbstractItemModel):
+    # Subfolders of an expanded folder that are listed ahead of time
+    PREFETCH_LIMIT = 50
+    # Files listed per folder before a "load more" row is added
+    PAGE_SIZE = 1000
+
+    SIZE_HINT = QtCore.QSize(20, 20)
+    ICON_FILES = {
+        'deleted':  'File0104.png',
+        'folder':   'File0059.png',
+        'binary':   'File0315.png',
+        'text':     'File0027.png',
+        'other':    'File0106.png',
+    }
+
     def __init__(self, p4, parent=None):
         super(PerforceItemModel, self).__init__(parent)
 
         self.p4 = p4
         self.showDeleted = False
+        # Only files whose type contains typeFilter are listed
+        self.typeFilter = ''
+        # Filename pattern, p4 only supports * wildcards
+        self.nameFilter = ''
+        self.icons = {}
+        self.root = None
         self.rootItem = None
 
-    def populate(self, rootdir):
-        self.rootItem = PerforceItem(None)
-        Utils.p4Logger().debug('Populating: %s' % rootdir)
-        self.populateSubDir(idx=None, root=rootdir)
+        self.openedFiles = None
+        self.openedFilesLock = threading.Lock()
 
-    def populateSubDir(self, idx=None, root="//depot"):
-        # Overcomplicated way to figure out if idx is root or not
-        # Would be better to check if .parent() exists and if not return the root path
-        if idx:
-            idxPathModel = PerforceItem.absoluteP4Path(idx)
-            idxPathSubDirs = [idxPath.data() for idxPath in idxPathModel]
-            idxFullPath = '/'.join(idxPathSubDirs)
+        self.worker = FstatWorker(p4, self.listDir)
+        self.worker.loaded.connect(self.onDirLoaded, QtCore.Qt.QueuedConnection)
+        self.worker.failed.connect(self.onDirFailed, QtCore.Qt.QueuedConnection)
 
-            p4path = '/'.join([root, idxFullPath])
-            treeItem = idx.internalPointer()
+    def populate(self, rootdir):
+        self.beginResetModel()
+        self.root = rootdir
+        self.rootItem = PerforceItem(None)
+        self.endResetModel()
 
-            # Pop empty "None" child
-            treeItem.popChild()
-        else:
-            p4path = root
-            treeItem = self.rootItem
+        with self.openedFilesLock:
+            self.openedFiles = None
 
+        Utils.p4Logger().debug('Populating: %s' % rootdir)
+        self.requestDir(self.rootItem)
+
+    def setFilters(self, typeFilter=None, nameFilter=None, showDeleted=None):
+        if typeFilter is not None:
+            self.typeFilter = typeFilter
+        if nameFilter is not None:
+            self.nameFilter = nameFilter
+        if showDeleted is not None:
+            self.showDeleted = showDeleted
+        if self.root:
+            self.populate(self.root)
+
+    def itemFromIndex(self, idx):
+        if not idx.isValid():
+            return self.rootItem
+        return idx.internalPointer()
+
+    def indexFromItem(self, item):
+        if item is self.rootItem:
+            return QtCore.QModelIndex()
+        return self.createIndex(item.row(), 0, item)
+
+    def itemPath(self, item):
+        # Full path is stored in the final column
+        if item is self.rootItem:
+            return self.root
+        return item.path
+
+    def isCurrentItem(self, item):
+        # Results for items of a previous populate() are thrown away
+        while item.parentItem:
+            item = item.parentItem
+        return item is self.rootItem
+
+    def requestDir(self, item, priority=0):
+        if item.loadState != PerforceItem.UNLOADED:
+            return
+        item.loadState = PerforceItem.LOADING
+        self.worker.request(item, (self.root, self.itemPath(item)), priority)
+
+    def loadMore(self, idx):
+        '''Request the next page of a folder if idx is its "load more" row, returns False otherwise'''
+        moreItem = idx.internalPointer() if idx.isValid() else None
+        if moreItem is None or not moreItem.isMoreItem():
+            return False
+
+        item = moreItem.parentItem
+        if item.loadState == PerforceItem.LOADED:
+            item.loadState = PerforceItem.LOADING
+            moreItem.name = 'Loading...'
+            moreIdx = self.indexFromItem(moreItem)
+            self.dataChanged.emit(moreIdx, moreIdx)
+            self.worker.request(item, (self.root, self.itemPath(item), moreItem.path), 0)
+        return True
+
+    def prefetch(self, idx):
+        '''
+        List the subfolders of idx in the background,
+        so they are already loaded when the user expands them
+        '''
+        item = self.itemFromIndex(idx)
+        folders = [child for child in item.childItems if child.isFolder()]
+        for child in folders[:self.PREFETCH_LIMIT]:
+            self.requestDir(child, priority=1)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        item = self.itemFromIndex(parent)
+        if item is None:
+            return False
+        if item.loadState == PerforceItem.LOADED:
+            return bool(item.childItems)
+        return True
+
+    def canFetchMore(self, parent):
+        item = self.itemFromIndex(parent)
+        return item is not None and item.loadState == PerforceItem.UNLOADED
+
+    def fetchMore(self, parent):
+        item = self.itemFromIndex(parent)
+        if item is not None:
+            self.requestDir(item)
+
+    def onDirLoaded(self, item, result):
+        folders, files, lastDepotFile, priority = result
+        if item.loadState != PerforceItem.LOADING or not self.isCurrentItem(item):
+            return
+
+        parent = self.indexFromItem(item)
+
+        # A further page replaces the "load more" row it was requested from
+        if item.childItems and item.childItems[-1].isMoreItem():
+            last = len(item.childItems) - 1
+            self.beginRemoveRows(parent, last, last)
+            item.popChild()
+            self.endRemoveRows()
+
+        first = len(item.childItems)
+        count = len(folders) + len(files) + (1 if lastDepotFile else 0)
+        if not count:
+            # Nothing to insert, but views have to drop the expand arrow
+            self.layoutAboutToBeChanged.emit()
+            item.loadState = PerforceItem.LOADED
+            self.layoutChanged.emit()
+            return
+
+        self.beginInsertRows(parent, first, first + count - 1)
+        for dirpath in folders:
+            item.appendFolderItem(dirpath)
+        for fileData in files:
+            item.appendFileItem(*fileData)
+        if lastDepotFile:
+            item.appendMoreItem(lastDepotFile)
+        item.loadState = PerforceItem.LOADED
+        self.endInsertRows()
+
+        # Folders loaded for the user are about to be browsed, get the next level ready
+        if priority == 0:
+            self.prefetch(parent)
+
+    def onDirFailed(self, item, error):
+        Utils.p4Logger().error(error)
+        if item.loadState == PerforceItem.LOADING:
+            item.loadState = PerforceItem.LOADED
+
+    def openedFilesIndex(self, p4):
+        # Built once per populate() on the worker thread
+        with self.openedFilesLock:
+            if self.openedFiles is None:
+                self.openedFiles = OpenedFilesIndex.fromConnection(p4)
+            return self.openedFiles
+
+    def fstatFilter(self, isClientPath, after=None):
+        '''Build the 'fstat -F' expression, so filtered out files never leave the server'''
+        return FstatFilter.fstatFilter(isClientPath, self.typeFilter, after)
+
+    def listDir(self, p4, root, p4path, after=None):
+        '''
+        Query one page of the folders and files directly under p4path, continuing after the
+        depot file 'after'. Returns the folder paths, the file data and the depot file to
+        continue from if the folder has more files.
+        Runs on the worker thread, so it must only use the given connection and not touch any items.
+        '''
         isDepotPath = root.startswith("//depot")
         isClientPath = not isDepotPath
-        clientRoot = "//{0}".format(self.p4.client)
+        clientRoot = "//{0}".format(p4.client)
+
+        folderPaths = []
+        filesData = []
+
+        with p4.at_exception_level(P4.RAISE_ERRORS):
+            if not after:
+                dirs_args = ['/'.join([p4path, '*'])]
+                if isDepotPath:
+                    dirs_args.insert(0, '-D')
+                for d in p4.run_dirs(*dirs_args):
+                    # For some reason we get the depot path, we ~should~ be safe with a simple replace
+                    dirpath = d['dir']
+                    if isClientPath:
+                        dirpath = dirpath.replace('//depot', clientRoot)
+                    folderPaths.append(dirpath)
+
+            # Ask for one file more than a page to know if there is another one
+            fstat_args = ['-Olhp', '-m', str(self.PAGE_SIZE + 1)]
+            fstatFilter = self.fstatFilter(isClientPath, after)
+            if fstatFilter:
+                fstat_args.extend(['-F', fstatFilter])
+            fstat_args.append('/'.join([p4path, self.nameFilter or '*']))
+            files = [f for f in p4.run_fstat(*fstat_args, records=True) if f.get('depotFile')]
+
+        lastDepotFile = None
+        if len(files) > self.PAGE_SIZE:
+            files = files[:self.PAGE_SIZE]
+            lastDepotFile = files[-1]['depotFile']
+
+        for f in files:
+            filepath = f['depotFile'] if isDepotPath else f['clientFile']
+
+            # Check if this is in a pending changelist,
+            # which gives us different fields to query
+            if f.get('change'):
+                filesData.append( (filepath, f['type'], '', f['action'], f['workRev']) )
+            else:
+                filesData.append( (filepath, f['headType'], f['headTime'], f['headAction'], f['headRev']) )
 
-        # dirpath = '/'.join([p4path,'*'])
+        if after:
+            return folderPaths, filesData, lastDepotFile
 
-        with self.p4.at_exception_level(P4.RAISE_ERRORS):
-            fstat_args = ['-Olhp', '-Dl', '/'.join([p4path,'*'])]
-            # if not showDeleted:
-            #     fstat_args.insert(1, '-F "^headAction=delete & ^headAction=move/delete"')
-            p4fstat = self.p4.run_fstat(*fstat_args)
-
-            files = []
-            folders = []
-            for f in p4fstat:
-                # p4 fstat returns directory information as well
-                if f.get('dir'):
-                    folders.append(f)
-                else:
-                    files.append(f)
-
-            for f in folders:
-                # For some reason fstat gives us the depot path, we ~should~ be safe with a simple replace
-                if isClientPath:
-                    f['dir'] = f['dir'].replace('//depot', clientRoot)
-
-                Utils.p4Logger().debug('Dir: \t%s' % f['dir'] )
-                treeItem.appendFolderItem(f['dir'])
-            
-            for f in files:
-                filepath = f['depotFile'] if isDepotPath else f['clientFile']
-                Utils.p4Logger().debug('File: \t%s' % filepath)
-
-                # Check if this is in a pending changelist,
-                # which gives us different fields to query
-                if f.get('change'):
-                    if f['action'] in ['delete','move/delete'] and isClientPath:
-                        continue
-
-                    treeItem.appendFileItem( filepath, f['type'], '', f['action'], f['workRev'] )
-                else:
-                    # Only show deleted files in depot view (for the purpose of undeleting them)
-                    if f['headAction'] in ['delete','move/delete'] and isClientPath:
-                        continue
-
-                    treeItem.appendFileItem( filepath, f['headType'], f['headTime'], f['headAction'], f['headRev'] )
-
-            # Show pending changelist folders in client view
-            # (fstat is configured to automatically add the files above if they exist in the current directory,
-            # but if they exist in a subdir they won't be found by default)
-            if isClientPath:
-                # if not showDeleted:
-                #     fstat_args.insert(1, '-F "^headAction=delete & ^headAction=move/delete"')
-
-                # Query pending changes (just default for now)
-                fstat_pending_args = ['-Or', '-F', 'change=default', '/'.join([p4path,'...'])]
-                p4fstat = self.p4.run_fstat(*fstat_pending_args)
-                if p4fstat:
-                    p4fstat = p4fstat[0]
-                    Utils.p4Logger().debug('fstat(%s): %s' % (fstat_pending_args, p4fstat['clientFile']))
-
-                    workspaceRoot = os.path.normpath(self.p4.run_info()[0]['clientRoot'].replace('\\', '/'))
-                    p4path = os.path.normpath(p4path).replace(workspaceRoot, '')
-                    p4PendingPath = os.path.normpath(p4fstat['clientFile']).replace(workspaceRoot, '')
-
-                    pendingPath, pendingFile = os.path.split(p4PendingPath)
-                    pendingPathSplit = pendingPath.split(os.sep)
-                    commonPrefixSplit = os.path.commonprefix([pendingPath, p4path]).split(os.sep)
-                    uncommonDirectories = filter(lambda x: x not in commonPrefixSplit, pendingPathSplit) 
-
-                    if uncommonDirectories:
-                        currentDir = uncommonDirectories[0]
-                        currentFolders = [ os.path.basename(f['dir']) for f in folders ]
-
-                        Utils.p4Logger().debug( commonPrefixSplit )
-                        Utils.p4Logger().debug( uncommonDirectories )
-                        if not currentDir in currentFolders:
-                            Utils.p4Logger().debug('Adding pending path folder')
-                            treeItem.appendFolderItem( os.path.join(p4path, currentDir) )
-
-        Utils.p4Logger().debug('\n\n')
+        # Show folders with pending files in client view
+        # (p4 dirs only reports folders with submitted files, folders holding nothing but
+        # opened files wouldn't be found otherwise)
+        if isClientPath:
+            openedFiles = self.openedFilesIndex(p4)
+            currentFolders = [ os.path.basename(dirpath) for dirpath in folderPaths ]
+            for dirName in openedFiles.childFolders(openedFiles.toClientPath(p4path)):
+                if not dirName in currentFolders:
+                    Utils.p4Logger().debug('Adding pending path folder %s' % dirName)
+                    folderPaths.append('/'.join([p4path, dirName]))
+
+        return folderPaths, filesData, lastDepotFile
 
     def p4Filelist(self, path):
         results = []
@@ -220,31 +497,39 @@ class PerforceItemModel(QtCore.QAbstractItemModel):
             return None
         if role == QtCore.Qt.DisplayRole:
             item = index.internalPointer()
-            return item.data[column]
+            return item.column(column)
         elif role == QtCore.Qt.SizeHintRole:
-            return QtCore.QSize(20, 20)
+            return self.SIZE_HINT
         elif role == QtCore.Qt.DecorationRole:
             if column == 1:
-                itemType = index.internalPointer().data[column]
-                isDeleted = index.internalPointer().data[3] == 'delete'
-
-                if isDeleted:
-                    return QtGui.QIcon(os.path.join(interop.getIconPath(), 'File0104.png'))
-
-                # Try to figure out which icon is most applicable to the item
-                if itemType == "Folder":
-                    return QtGui.QIcon(os.path.join(interop.getIconPath(), 'File0059.png'))
-                elif "binary" in itemType:
-                    return QtGui.QIcon(os.path.join(interop.getIconPath(), 'File0315.png'))
-                elif "text" in itemType:
-                    return QtGui.QIcon(os.path.join(interop.getIconPath(), 'File0027.png'))
-                else:
-                    return QtGui.QIcon(os.path.join(interop.getIconPath(), 'File0106.png'))
+                return self.icon(self.iconClass(index.internalPointer()))
             else:
                 return None
 
         return None
 
+    @staticmethod
+    def iconClass(item):
+        # Try to figure out which icon is most applicable to the item
+        if item.action == 'delete':
+            return 'deleted'
+        elif item.fileType == "Folder":
+            return 'folder'
+        elif "binary" in item.fileType:
+            return 'binary'
+        elif "text" in item.fileType:
+            return 'text'
+        else:
+            return 'other'
+
+    def icon(self, iconClass):
+        # Icons are loaded once per model, repaints don't touch the disk
+        icon = self.icons.get(iconClass)
+        if icon is None:
+            icon = QtGui.QIcon(os.path.join(interop.getIconPath(), self.ICON_FILES[iconClass]))
+            self.icons[iconClass] = icon
+        return icon
+
     def flags(self, index):
         if not index.isValid():
             return QtCore.Qt.NoItemFlags
@@ -1,13 +1,15 @@
 import os
 import sys
-from P4 import P4, P4Exception
+from P4 import P4Exception
 from qtpy import QtCore, QtGui, QtWidgets
 
 from perforce import Utils
 from perforce.PerforceUtils import CmdsChangelist
+from perforce.PerforceUtils.PreviewCache import PreviewCache
 from perforce.AppInterop import interop
 from ErrorMessageWindow import displayErrorUI
 import DepotClientViewModel
+import RevisionHistory
 
 class BaseRevisionTab(QtWidgets.QWidget):
     def __init__(self, p4, parent=None):
@@ -23,6 +25,13 @@ class BaseRevisionTab(QtWidgets.QWidget):
         self.setWindowFlags(QtCore.Qt.Window)
 
         self.fileRevisions = []
+        self.currentFile = None
+
+        self.previewCache = PreviewCache(os.path.join(interop.getTempPath(), "p4_previews"))
+
+        self.history = RevisionHistory.RevisionHistory(self.p4)
+        self.history.loaded.connect(self.onHistoryLoaded, QtCore.Qt.QueuedConnection)
+        self.history.failed.connect(self.onHistoryFailed, QtCore.Qt.QueuedConnection)
 
     def create(self):
         self.create_controls()
@@ -55,6 +64,11 @@ class BaseRevisionTab(QtWidgets.QWidget):
         # self.model.populate(self.root, showDeleted=False)
         # self.model.populate('//depot', showDeleted=True)
 
+        self.nameFilterEdit = QtWidgets.QLineEdit()
+        self.nameFilterEdit.setPlaceholderText("Filter files, e.g. *.ma")
+        self.typeFilterCombo = QtWidgets.QComboBox()
+        self.typeFilterCombo.addItems(["All types", "binary", "text"])
+
         self.fileTree = QtWidgets.QTreeView()
         self.fileTree.expandAll()
         # self.fileTree.setModel(self.model)
@@ -100,6 +114,11 @@ class BaseRevisionTab(QtWidgets.QWidget):
         main_layout = QtWidgets.QVBoxLayout()
         main_layout.setContentsMargins(6, 6, 6, 6)
 
+        filterLayout = QtWidgets.QHBoxLayout()
+        filterLayout.addWidget(self.nameFilterEdit)
+        filterLayout.addWidget(self.typeFilterCombo)
+
+        main_layout.addLayout(filterLayout)
         main_layout.addWidget(self.fileTree)
         main_layout.addWidget(self.tableWidget)
 
@@ -120,8 +139,12 @@ class BaseRevisionTab(QtWidgets.QWidget):
         '''
         Create the signal/slot connections
         '''
-        self.fileTree.clicked.connect(self.populateFileRevisions)
+        # Follows keyboard navigation as well as clicks
+        self.fileTree.selectionModel().selectionChanged.connect(self.populateFileRevisions)
+        self.fileTree.clicked.connect(self.onTreeClicked)
         self.fileTree.expanded.connect(self.onExpandedFolder)
+        self.nameFilterEdit.editingFinished.connect(self.onFilterChanged)
+        self.typeFilterCombo.currentIndexChanged.connect(self.onFilterChanged)
         self.getLatestBtn.clicked.connect(self.onSyncLatest)
         self.getRevisionBtn.clicked.connect(self.onRevertToSelection)
         self.getPreviewBtn.clicked.connect(self.getPreview)
@@ -136,12 +159,23 @@ class BaseRevisionTab(QtWidgets.QWidget):
 
         Utils.p4Logger().debug('Expanding %s...' % treeItem.data[-1])
 
-        if not index.child(0,0).isValid():
-            Utils.p4Logger().debug('\tLoading empty directory')
-            self.model.populateSubDir(index, self.root)
+        # The view asks the model to fetch the folder itself,
+        # start listing the folders below it while the user looks around
+        self.model.prefetch(index)
 
-        self.fileTree.setModel(self.model)
-        self.model.layoutChanged.emit()
+    def onTreeClicked(self, index):
+        # Clicking the selected "load more" row again doesn't change the selection
+        self.model.loadMore(index)
+
+    def onFilterChanged(self, *args):
+        typeFilter = ''
+        if self.typeFilterCombo.currentIndex() > 0:
+            typeFilter = self.typeFilterCombo.currentText()
+        nameFilter = self.nameFilterEdit.text().strip()
+
+        if (typeFilter, nameFilter) != (self.model.typeFilter, self.model.nameFilter):
+            self.clearRevisions()
+            self.model.setFilters(typeFilter=typeFilter, nameFilter=nameFilter)
 
     def getPreview(self, *args):
         index = self.tableWidget.currentRow()
@@ -156,11 +190,8 @@ class BaseRevisionTab(QtWidgets.QWidget):
         filePath = data[-1]
         fileName = data[0]
 
-        path = os.path.join(interop.getTempPath(), fileName)
-
         try:
-            tmpPath = path
-            self.p4.run_print("-o", tmpPath, "{0}#{1}".format(filePath, revision))
+            tmpPath = self.previewCache.fetch(self.p4, "{0}#{1}".format(filePath, revision), fileName)
             Utils.p4Logger().info("Synced preview to {0} at revision {1}".format(tmpPath, revision))
             if self.isSceneFile:
                 interop.openScene(tmpPath)
@@ -265,6 +296,9 @@ class BaseRevisionTab(QtWidgets.QWidget):
             return
         index = index[0]
 
+        if self.model.loadMore(index):
+            return
+
         try:
             name, filetype, time, action, change, fullname = index.internalPointer().data
         except ValueError as e:
@@ -281,6 +315,7 @@ class BaseRevisionTab(QtWidgets.QWidget):
             self.getLatestBtn.setVisible(False)
             self.getPreviewBtn.setVisible(False)
             self.isSceneFile = False
+            self.currentFile = None
             self.clearRevisions()
             return
         else:
@@ -297,10 +332,25 @@ class BaseRevisionTab(QtWidgets.QWidget):
             self.isSceneFile = False
 
 
-        try:
-            with self.p4.at_exception_level(P4.RAISE_ERRORS):
-                files = self.p4.run_filelog("-l", fullname)
-        except P4Exception as e:
+        # The revision table fills in once the history arrives from the loader thread
+        self.currentFile = fullname
+        self.statusBar.showMessage("Loading history of {0}...".format(os.path.basename(fullname)))
+        self.history.request(fullname)
+
+    def onHistoryFailed(self, fullname, error):
+        if fullname != self.currentFile:
+            return
+        Utils.p4Logger().error(error)
+        self.statusBar.showMessage("Couldn't load history of {0}".format(os.path.basename(fullname)))
+        self.clearRevisions()
+
+    def onHistoryLoaded(self, fullname, fileInfo, depotFile):
+        # Results for a file that is no longer selected are dropped
+        if fullname != self.currentFile:
+            return
+        self.statusBar.showMessage("")
+
+        if depotFile is None:
             # TODO - Better error handling here, what if we can't connect etc
             #eMsg, type = parsePerforceError(e)
             self.statusBar.showMessage("{0} isn't on client".format(os.path.basename(fullname)))
@@ -312,38 +362,31 @@ class BaseRevisionTab(QtWidgets.QWidget):
         self.getLatestBtn.setEnabled(True)
         self.getPreviewBtn.setEnabled(True)
 
-        try:
-            with self.p4.at_exception_level(P4.RAISE_ERRORS):
-                p4FileInfo = self.p4.run_fstat(fullname)
-
-            if p4FileInfo:
-                fileInfo = p4FileInfo[0]
-                
-                if 'otherLock' in fileInfo:
-                    self.statusBar.showMessage("{0} currently locked by {1}".format(os.path.basename(fullname), fileInfo['otherLock'][0]))
-
-                    if fileInfo['otherLock'][0].split('@')[0] != self.p4.user:
-                        self.getRevisionBtn.setEnabled(False)
-                elif 'otherOpen' in fileInfo:
-                    self.statusBar.showMessage("{0} currently opened by {1}".format(os.path.basename(fullname), fileInfo['otherOpen'][0]))
-
-                    if fileInfo['otherOpen'][0].split('@')[0] != self.p4.user:
-                        self.getRevisionBtn.setEnabled(False)
-                else:
-                    self.statusBar.showMessage("{0} currently opened by {1}@{2}".format(os.path.basename(fullname),  self.p4.user, self.p4.client))
-                    self.getRevisionBtn.setEnabled(True)
-
-        except P4Exception:
+        if fileInfo:
+            if 'otherLock' in fileInfo:
+                self.statusBar.showMessage("{0} currently locked by {1}".format(os.path.basename(fullname), fileInfo['otherLock'][0]))
+
+                if fileInfo['otherLock'][0].split('@')[0] != self.p4.user:
+                    self.getRevisionBtn.setEnabled(False)
+            elif 'otherOpen' in fileInfo:
+                self.statusBar.showMessage("{0} currently opened by {1}".format(os.path.basename(fullname), fileInfo['otherOpen'][0]))
+
+                if fileInfo['otherOpen'][0].split('@')[0] != self.p4.user:
+                    self.getRevisionBtn.setEnabled(False)
+            else:
+                self.statusBar.showMessage("{0} currently opened by {1}@{2}".format(os.path.basename(fullname),  self.p4.user, self.p4.client))
+                self.getRevisionBtn.setEnabled(True)
+        else:
             self.statusBar.showMessage("{0} is not checked out".format(os.path.basename(fullname)))
             self.getRevisionBtn.setEnabled(True)
 
         # Generate revision dictionary
         self.fileRevisions = []
 
-        if files:
-            Utils.p4Logger().debug( 'filelog(%s):%s' % (fullname, files) )
+        if depotFile:
+            Utils.p4Logger().debug( 'filelog(%s):%s' % (fullname, depotFile) )
 
-            for revision in files[0].each_revision():
+            for revision in depotFile.each_revision():
                 self.fileRevisions.append({"revision": revision.rev,
                                            "action": revision.action,
                                            "date": revision.time,
@@ -141,7 +141,7 @@ class OpenedFilesUI(QtWidgets.QDialog):
 
     def updateTable(self):
         fileList = self.p4.run_opened(
-            "-u", self.p4.user, "-C", self.p4.client, "...")
+            "-u", self.p4.user, "-C", self.p4.client, "...", records=True)
 
         self.entries = []
         for file in fileList:
@@ -7,6 +7,7 @@ from P4 import P4, P4Exception
 
 from perforce import Utils
 from perforce.PerforceUtils import SetupConnection
+from perforce.PerforceUtils.ParallelSync import ParallelSync
 from perforce.AppInterop import interop
 from perforce.PerforceUtils.TestOutputAndProgress import TestOutputAndProgress
 from perforce.GUI.SubmitProgressWindow import SubmitProgressUI
@@ -19,12 +20,22 @@ import FileRevisionWindow
 
 from qtpy import QtCore, QtGui, QtWidgets
 
+class SyncSignals(QtCore.QObject):
+    '''Brings the callbacks of a ParallelSync from its worker threads to the UI thread'''
+    # files, bytes
+    previewed = QtCore.Signal(int, object)
+    progress = QtCore.Signal(int, object)
+    # errors
+    finished = QtCore.Signal(object)
+
 class MainShelf:
 
     def __init__(self, p4):
         self.p4 = p4
         self.deleteUI = None
         self.submitUI = None
+        self.syncUI = None
+        self.syncer = None
 
     def close(self):
         # @ToDo this stll seems to be maya specific
@@ -52,6 +63,11 @@ class MainShelf:
         except Exception as e:
             print "Error cleaning up P4 submit UI : ", e
 
+        if self.syncer is not None:
+            self.syncer.setCancel(True)
+
+        SetupConnection.closeConnectionPool(self.p4)
+
         Utils.p4Logger().info("Disconnecting from server")
         try:
             self.p4.disconnect()
@@ -206,6 +222,9 @@ class MainShelf:
                 else:
                     self.p4.set_env('P4CLIENT', self.p4.client)
 
+                # Pooled connections still use the previous client
+                SetupConnection.connectionPool(self.p4).clear()
+
                 Utils.writeToP4Config(
                     self.p4.p4config_file, "P4CLIENT", self.p4.client)
                 break
@@ -507,22 +526,53 @@ class MainShelf:
         if reply == QtWidgets.QMessageBox.No:
             return
 
-        # progress = SubmitProgressUI(len(files))
-        # progress.create("Submit Progress")
-
-        # callback = TestOutputAndProgress(progress)
-
-        # progress.show()
-
-        try:
-            self.p4.run_sync("-f", "...")
-            Utils.p4Logger().info("Got latest revisions for client")
-        except P4Exception as e:
-            displayErrorUI(e)
+        self.__syncParallel("Sync All - Force", "-f", "//{0}/...".format(self.p4.client))
 
     def syncAllChanged(self, *args):
-        try:
-            self.p4.run_sync("...")
-            Utils.p4Logger().info("Got latest revisions for client")
-        except P4Exception as e:
-            displayErrorUI(e)
\ No newline at end of file
+        self.__syncParallel("Sync All", "//{0}/...".format(self.p4.client))
+
+    # Sync on background threads over pooled connections, showing the progress
+    # in a SubmitProgressUI that can cancel it
+    def __syncParallel(self, title, *p4args):
+        if self.syncer is not None and self.syncer.isRunning():
+            QtWidgets.QMessageBox.information(
+                interop.main_parent_window(), title, "A sync is already running")
+            return
+
+        progress = SubmitProgressUI(0)
+        progress.create(title)
+
+        signals = SyncSignals()
+        syncer = ParallelSync(SetupConnection.connectionPool(self.p4),
+                              previewed=signals.previewed.emit,
+                              progress=signals.progress.emit,
+                              finished=signals.finished.emit)
+        progress.setHandler(syncer)
+
+        def onPreviewed(files, size):
+            progress.setTotal(files)
+
+        def onProgress(files, size):
+            progress.setCurrent(files)
+            if syncer.totalBytes:
+                progress.setValue(int(100 * size / syncer.totalBytes))
+
+        def onFinished(errors):
+            if syncer.cancelled or errors:
+                progress.setComplete(False)
+                for e in errors:
+                    Utils.p4Logger().error(e)
+                if errors and not syncer.cancelled:
+                    displayErrorUI(errors[0])
+            else:
+                Utils.p4Logger().info("Got latest revisions for client")
+                progress.close()
+
+        signals.previewed.connect(onPreviewed, QtCore.Qt.QueuedConnection)
+        signals.progress.connect(onProgress, QtCore.Qt.QueuedConnection)
+        signals.finished.connect(onFinished, QtCore.Qt.QueuedConnection)
+
+        self.syncUI = (progress, signals)
+        self.syncer = syncer
+        progress.show()
+        syncer.start(*p4args)
\ No newline at end of file
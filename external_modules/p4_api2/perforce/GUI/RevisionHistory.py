@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+from P4 import P4, P4Exception
+from qtpy import QtCore
+
+import perforce.Utils as Utils
+from perforce.PerforceUtils import SetupConnection
+from perforce.PerforceUtils.IdleWorker import IdleWorker, LatestItem
+
+class RevisionHistory(QtCore.QObject):
+    '''
+    Loads the fstat and filelog of files for the revision window on a background thread,
+    with a connection checked out from the pool shared by the windows.
+
+    Only the newest request is served, so stepping through a folder doesn't queue up
+    a history per file. Filelogs are kept in an LRU keyed by depot file and head change:
+    the fstat tells if a file was submitted to since, otherwise the cached filelog is used.
+    The signals are emitted from the worker thread.
+    '''
+    # path, fstat record (None if it failed), DepotFile (None if the file has no history)
+    loaded = QtCore.Signal(object, object, object)
+    failed = QtCore.Signal(object, object)
+
+    CACHE_SIZE = 200
+
+    def __init__(self, p4, cacheSize=None, parent=None):
+        super(RevisionHistory, self).__init__(parent)
+
+        self.p4 = p4
+        self.cacheSize = cacheSize or self.CACHE_SIZE
+        self.pool = SetupConnection.connectionPool(p4)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._worker = IdleWorker(self._loadHistory, "P4History", LatestItem())
+
+    def request(self, path):
+        self._worker.put(path)
+
+    def invalidate(self, depotFile=None):
+        with self._lock:
+            if depotFile is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(depotFile, None)
+
+    def _loadHistory(self, path):
+        try:
+            with self.pool.connection() as p4:
+                fileInfo, depotFile = self._load(p4, path)
+        except Exception as e:
+            self.failed.emit(path, e)
+            return
+        self.loaded.emit(path, fileInfo, depotFile)
+
+    def _load(self, p4, path):
+        try:
+            with p4.at_exception_level(P4.RAISE_ERRORS):
+                p4FileInfo = p4.run_fstat(path)
+            fileInfo = p4FileInfo[0] if p4FileInfo else None
+        except P4Exception:
+            fileInfo = None
+
+        key = fileInfo.get('depotFile') if fileInfo else path
+        headChange = fileInfo.get('headChange') if fileInfo else None
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached and headChange and cached[0] == headChange:
+                self._cache[key] = cached
+                return fileInfo, cached[1]
+
+        try:
+            with p4.at_exception_level(P4.RAISE_ERRORS):
+                files = p4.run_filelog("-l", path)
+        except P4Exception as e:
+            Utils.p4Logger().debug(e)
+            return fileInfo, None
+        depotFile = files[0] if files else None
+
+        if depotFile is not None and headChange:
+            with self._lock:
+                self._cache[key] = (headChange, depotFile)
+                while len(self._cache) > self.cacheSize:
+                    self._cache.popitem(last=False)
+        return fileInfo, depotFile
@@ -14,6 +14,7 @@ class SubmitProgressUI(QtWidgets.QDialog):
         self.totalFiles = totalFiles
 
         self.currentFile = 0
+        self.complete = False
 
     def setHandler(self, handler):
         self.handler = handler
@@ -27,6 +28,17 @@ class SubmitProgressUI(QtWidgets.QDialog):
     def setValue(self, val):
         self.fileProgressBar.setValue(val)
 
+    def setTotal(self, totalFiles):
+        self.totalFiles = totalFiles
+        self.overallProgressBar.setMaximum(totalFiles)
+
+    def setCurrent(self, currentFile):
+        self.currentFile = currentFile
+        self.overallProgressBar.setValue(self.currentFile)
+
+        if self.currentFile >= self.totalFiles:
+            self.setComplete(True)
+
     def incrementCurrent(self):
         self.currentFile += 1
         self.overallProgressBar.setValue(self.currentFile)
@@ -37,6 +49,7 @@ class SubmitProgressUI(QtWidgets.QDialog):
             self.setComplete(True)
 
     def setComplete(self, success):
+        self.complete = True
         if not success:
             self.overallProgressBar.setTextVisible(True)
             self.overallProgressBar.setFormat("Cancelled/Error")
@@ -102,5 +115,8 @@ class SubmitProgressUI(QtWidgets.QDialog):
     #--------------------------------------------------------------------------
 
     def cancelProgress(self, *args):
+        if self.complete:
+            self.close()
+            return
         self.quitBtn.setText("Cancelling...")
         self.handler.setCancel(True)
\ No newline at end of file
@@ -0,0 +1,24 @@
+import re
+
+# Files in the client view that aren't opened for delete, and are either opened
+# or have a head revision that isn't deleted. Files opened for add over a deleted
+# head revision are listed, deleted files are only shown in the depot view
+# (for the purpose of undeleting them)
+CLIENT_VIEW_TERM = ('^action=delete ^action=move/delete '
+                    '(action=* | (^headAction=delete ^headAction=move/delete))')
+
+def escapeFilterValue(value):
+    # Characters with a meaning in 'fstat -F' expressions are escaped with a backslash
+    return re.sub(r'([\s=^&|()<>~\\])', r'\\\1', value)
+
+def fstatFilter(isClientPath, typeFilter='', after=None):
+    '''Build the 'fstat -F' expression, so filtered out files never leave the server'''
+    terms = []
+    if isClientPath:
+        terms.append(CLIENT_VIEW_TERM)
+    if typeFilter:
+        # Files only opened for add have no head revision yet
+        terms.append('(headType=*{0}* | type=*{0}*)'.format(typeFilter))
+    if after:
+        terms.append('depotFile>{0}'.format(escapeFilterValue(after)))
+    return ' '.join(terms)
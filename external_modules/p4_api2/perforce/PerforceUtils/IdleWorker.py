@@ -0,0 +1,88 @@
+import time
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Same logger as perforce.Utils.p4Logger(), without importing P4
+logger = logging.getLogger("Perforce")
+
+class LatestItem(object):
+    '''Queue holding only the newest item, putting one replaces the one still waiting'''
+    def __init__(self):
+        self._item = None
+        self._full = False
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            self._item = item
+            self._full = True
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._full:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+            item, self._item, self._full = self._item, None, False
+            return item
+
+    def empty(self):
+        with self._cond:
+            return not self._full
+
+class IdleWorker(object):
+    '''
+    Calls handle(item) for the items put into a queue, on a background thread that is
+    started on demand. The thread ends once no item came for IDLE_TIMEOUT seconds and
+    the next put() starts a new one.
+
+    items is any queue with put, get(timeout) and empty, like a queue.PriorityQueue
+    or a LatestItem. Exceptions from handle() are logged and the next item is served.
+    '''
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, handle, name, items=None, idleTimeout=None):
+        self.handle = handle
+        self.name = name
+        self.items = queue.Queue() if items is None else items
+        self.idleTimeout = idleTimeout or self.IDLE_TIMEOUT
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        self.items.put(item)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def isRunning(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def _work(self):
+        while True:
+            try:
+                item = self.items.get(timeout=self.idleTimeout)
+            except queue.Empty:
+                with self._lock:
+                    # An item put before the lock was taken is served by this thread,
+                    # one put after it starts a new thread
+                    if self.items.empty():
+                        self._thread = None
+                        return
+                continue
+
+            try:
+                self.handle(item)
+            except Exception as e:
+                logger.error(e)
@@ -0,0 +1,165 @@
+import time
+import heapq
+import threading
+
+from P4 import P4, P4Exception, OutputHandler
+from perforce.Utils import p4Logger
+
+class SyncOutputHandler(OutputHandler):
+    '''Counts the files of a running sync command and cancels it once the sync is cancelled'''
+    def __init__(self, sync):
+        OutputHandler.__init__(self)
+        self.sync = sync
+
+    def outputStat(self, h):
+        self.sync._synced(int(h.get('fileSize') or 0))
+        if self.sync.cancelled:
+            return OutputHandler.CANCEL
+        return OutputHandler.HANDLED
+
+    def outputMessage(self, e):
+        if self.sync.cancelled:
+            return OutputHandler.REPORT | OutputHandler.CANCEL
+        return OutputHandler.REPORT
+
+class ParallelSync(object):
+    '''
+    Syncs a workspace over several connections from a P4Pool at once.
+
+    'sync -n' first lists the files that would be synced with their sizes. They are split
+    into one batch per connection of about the same size in bytes, and each batch is synced
+    in chunks of CHUNK_SIZE files pinned to the previewed revisions. With serverThreads the
+    files are synced by a single 'sync --parallel' instead, which needs net.parallel.max
+    set on the server.
+
+    By default one connection of the pool is left to other users of it, like the depot
+    view and history panes of the windows.
+
+    The callbacks are called from the worker threads:
+    previewed(files, bytes), progress(files, bytes) and finished(errors).
+    setCancel() matches the handler interface of SubmitProgressUI, a sync that was
+    cancelled before it started doesn't start at all.
+    '''
+    CHUNK_SIZE = 500
+    # Seconds between progress callbacks, syncs can report thousands of files a second
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, pool, workers=None, serverThreads=0, previewed=None, progress=None, finished=None):
+        self.pool = pool
+        self.workers = workers or max(1, pool.size - 1)
+        self.serverThreads = serverThreads
+        self.previewed = previewed
+        self.progress = progress
+        self.finished = finished
+
+        self.cancelled = False
+        self.errors = []
+        self.totalFiles = 0
+        self.totalBytes = 0
+        self.syncedFiles = 0
+        self.syncedBytes = 0
+        self._lastProgress = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def setCancel(self, val):
+        self.cancelled = val
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, *args):
+        '''Runs the sync on a background thread, args are the same as for run_sync'''
+        self._thread = threading.Thread(target=self.run, args=args, name="P4Sync")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, *args):
+        '''Syncs args and returns the errors, blocks until all batches are done'''
+        self.errors = []
+        self.syncedFiles = self.syncedBytes = 0
+
+        files = []
+        if not self.cancelled:
+            try:
+                with self.pool.connection() as p4:
+                    files = self.preview(p4, *args)
+            except P4Exception as e:
+                self.errors.append(e)
+        self.totalFiles = len(files)
+        self.totalBytes = sum(size for path, size in files)
+        p4Logger().info('Syncing %d files, %d bytes' % (self.totalFiles, self.totalBytes))
+        if self.previewed:
+            self.previewed(self.totalFiles, self.totalBytes)
+
+        flags = [arg for arg in args if arg.startswith('-')]
+        if self.serverThreads:
+            flags.append('--parallel=threads=%d' % self.serverThreads)
+            batches = self.balance(files, 1)
+        else:
+            batches = self.balance(files, self.workers)
+
+        threads = [threading.Thread(target=self._syncBatch, args=(batch, flags), name="P4SyncBatch") for batch in batches]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.progress:
+            self.progress(self.syncedFiles, self.syncedBytes)
+        if self.finished:
+            self.finished(self.errors)
+        return self.errors
+
+    def preview(self, p4, *args):
+        '''Returns (depotFile#rev, fileSize) for the files 'sync args' would sync'''
+        # 'File(s) up-to-date' is a warning
+        with p4.at_exception_level(P4.RAISE_ERRORS):
+            records = p4.run_sync('-n', *args, records=True)
+        return [('%s#%s' % (r['depotFile'], r['rev']), int(r.get('fileSize') or 0))
+                for r in records if 'depotFile' in r]
+
+    @staticmethod
+    def balance(files, count):
+        '''Splits (path, size) pairs into up to count batches of about the same total size'''
+        batches = [[] for i in range(count)]
+        sizes = [(0, i) for i in range(count)]
+        # Largest first, each file goes to the batch that is smallest so far
+        for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+            total, i = heapq.heappop(sizes)
+            batches[i].append(path)
+            heapq.heappush(sizes, (total + size, i))
+        return [batch for batch in batches if batch]
+
+    def _syncBatch(self, batch, flags):
+        handler = SyncOutputHandler(self)
+        try:
+            with self.pool.connection(exception_level=P4.RAISE_ERRORS) as p4:
+                for i in range(0, len(batch), self.CHUNK_SIZE):
+                    if self.cancelled:
+                        return
+                    try:
+                        p4.run_sync(flags + batch[i:i + self.CHUNK_SIZE], handler=handler)
+                    except P4Exception as e:
+                        if self.cancelled:
+                            return
+                        # Errors like unresolved or writable files only affect their own files
+                        p4Logger().warning(e)
+                        with self._lock:
+                            self.errors.append(e)
+        except Exception as e:
+            p4Logger().error(e)
+            with self._lock:
+                self.errors.append(e)
+
+    def _synced(self, size):
+        with self._lock:
+            self.syncedFiles += 1
+            self.syncedBytes += size
+            now = time.time()
+            if now - self._lastProgress < self.PROGRESS_INTERVAL:
+                return
+            self._lastProgress = now
+        if self.progress:
+            self.progress(self.syncedFiles, self.syncedBytes)
@@ -0,0 +1,94 @@
+import os
+import stat
+import shutil
+
+from P4 import P4
+from perforce.Utils import p4Logger
+
+class PreviewCache(object):
+    '''
+    Revisions printed for preview, stored by the MD5 digest the server keeps for them.
+
+    A revision is only printed once, previewing it again opens the stored file.
+    Each file sits in a folder named after its digest, so the file name and extension
+    are kept for the DCC opening it. When the cache grows over maxSize bytes the
+    least recently used previews are removed.
+    '''
+    MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+    def __init__(self, root, maxSize=None):
+        self.root = root
+        self.maxSize = maxSize or self.MAX_SIZE
+
+    def fetch(self, p4, fileRev, fileName):
+        '''Return a local copy of fileRev (path#rev), printed from the server only if it isn't cached yet'''
+        with p4.at_exception_level(P4.RAISE_ERRORS):
+            p4FileInfo = p4.run_fstat('-Ol', '-T', 'digest,fileSize', fileRev)
+        fileInfo = p4FileInfo[0] if p4FileInfo else {}
+
+        digest = fileInfo.get('digest')
+        if not digest:
+            # Without a digest (deleted revisions, very old servers) there's nothing to key on
+            path = os.path.join(self.root, 'uncached', fileName)
+            self._print(p4, fileRev, path)
+            return path
+
+        path = os.path.join(self.root, digest.upper(), fileName)
+        if os.path.isfile(path):
+            p4Logger().debug('Preview of %s found in cache' % fileRev)
+            # The folder's mtime is the last use
+            os.utime(os.path.dirname(path), None)
+            return path
+
+        self._print(p4, fileRev, path)
+        self.evict(keep=os.path.dirname(path))
+        return path
+
+    def _print(self, p4, fileRev, path):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        tmpPath = path + '.part'
+        if os.path.exists(tmpPath):
+            os.chmod(tmpPath, stat.S_IWRITE | stat.S_IREAD)
+            os.remove(tmpPath)
+        p4.run_print('-o', tmpPath, fileRev)
+        if os.path.exists(path):
+            os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+        # Stop the previewing DCC from saving over the cached revision
+        os.chmod(path, stat.S_IREAD)
+        p4Logger().info('Printed preview of %s to %s' % (fileRev, path))
+
+    def evict(self, keep=None):
+        if not os.path.isdir(self.root):
+            return
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            folder = os.path.join(self.root, name)
+            if not os.path.isdir(folder):
+                continue
+            size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+            entries.append((os.path.getmtime(folder), size, folder))
+            total += size
+
+        for mtime, size, folder in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if folder == keep:
+                continue
+            try:
+                for f in os.listdir(folder):
+                    os.chmod(os.path.join(folder, f), stat.S_IWRITE | stat.S_IREAD)
+                shutil.rmtree(folder)
+            except OSError as e:
+                # Still open in a DCC on Windows, try again next time
+                p4Logger().debug(e)
+                continue
+            total -= size
+            p4Logger().debug('Evicted preview %s' % folder)
@@ -1,6 +1,7 @@
 import os
+import threading
 
-from P4 import P4, P4Exception
+from P4 import P4, P4Exception, P4Pool
 
 from perforce.Utils import p4Logger
 
@@ -63,3 +64,32 @@ def connect(p4):
     #     p4Logger().debug( '\t%s:\t%s' % (key, info[key]) )
 
     p4Logger().debug("Perforce CWD: %s" % p4.cwd)
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def connectionPool(p4):
+    '''
+    The pool of connections with the settings of p4, shared by every window using p4.
+    Background work checks out a connection from it instead of opening its own.
+    '''
+    with _poolsLock:
+        pool = _pools.get(id(p4))
+        if pool is None or pool.template is not p4:
+            p4Logger().debug('Creating connection pool for %s' % p4.port)
+            pool = P4Pool(p4)
+            _pools[id(p4)] = pool
+        return pool
+
+def closeConnectionPool(p4):
+    '''
+    Close the pool of p4 and forget it, for when p4 itself is closed.
+    Connections that are still checked out are closed once they come back.
+    '''
+    with _poolsLock:
+        pool = _pools.get(id(p4))
+        if pool is None or pool.template is not p4:
+            return
+        del _pools[id(p4)]
+    p4Logger().debug('Closing connection pool for %s' % p4.port)
+    pool.close()
@@ -1,14 +1,27 @@
 import os
+import sys
 # Allow the user to override P4CONFIG with their own name or absolute path
 # But by default look for a .p4config file anywhere above the current working dir
 if not os.getenv('P4CONFIG'):
     os.environ['P4CONFIG'] = '.p4config'
 
+# The windows rely on additions to the P4 module bundled next to this package
+# (P4Pool, records=...), so it has to win over any other P4Python on the path
+bundledP4Path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if bundledP4Path in sys.path:
+    sys.path.remove(bundledP4Path)
+sys.path.insert(0, bundledP4Path)
+
 try:
+    import P4 as P4Module
     from P4 import P4, P4Exception
 except ImportError as e:
     raise ImportError('%s, ensure P4API is installed into your DCC script paths' % e)
 
+if not hasattr(P4Module, 'P4Pool') or not hasattr(P4Module, 'RecordOutputHandler'):
+    raise ImportError('%s was imported instead of the P4 module bundled in %s, '
+                      'the perforce tools need the bundled one' % (P4Module.__file__, bundledP4Path))
+
 import logging
 logging.basicConfig(
     format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno)s %(funcName)s %(message)s",
@@ -44,9 +44,18 @@ from __future__ import print_function
     """
 
 import sys, datetime
+import time
+import logging
 import re
 import shutil
 from contextlib import contextmanager
+import threading
+import io
+import codecs
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import uuid, tempfile
 import os, os.path, platform
 import subprocess
@@ -390,6 +399,180 @@ def processFilelog(h):
     else:
         raise Exception("Not a filelog object: " + h)
 
+class PrintOutputHandler(OutputHandler):
+    """Passes the content printed by 'p4 print' on as it arrives instead of collecting it.
+    
+    output is either a writable file object, which receives the content of all printed
+    files one after another, or a callable, which is called with the header of the
+    current file and each chunk of its content. The headers are kept in files.
+    """
+    def __init__(self, output, encoding=None):
+        OutputHandler.__init__(self)
+        self.files = []
+        self.decoder = None
+        # Text is decoded unless the encoding is raw, binary content always arrives as bytes
+        self.encoding = encoding if encoding and encoding != 'raw' else 'utf8'
+        if not hasattr(output, "write"):
+            self.write = lambda chunk: output(self.files[-1], chunk)
+        elif isinstance(output, io.TextIOBase):
+            self.write = lambda chunk: output.write(self.__decode(chunk))
+        else:
+            # Files opened in binary mode, BytesIO, GzipFile and the like take bytes
+            self.write = lambda chunk: output.write(chunk if isinstance(chunk, bytes) else chunk.encode(self.encoding))
+    
+    def __decode(self, chunk):
+        if not isinstance(chunk, bytes):
+            return chunk
+        # Chunks can end in the middle of a multi-byte character
+        if self.decoder is None:
+            self.decoder = codecs.getincrementaldecoder(self.encoding)()
+        return self.decoder.decode(chunk)
+    
+    def outputStat(self, h):
+        self.files.append(h)
+        self.decoder = None
+        return OutputHandler.HANDLED
+    
+    def outputText(self, s):
+        self.write(s)
+        return OutputHandler.HANDLED
+    
+    def outputBinary(self, b):
+        self.write(b)
+        return OutputHandler.HANDLED
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+def _intern(s):
+    # Unicode strings can't be interned on Python 2
+    try:
+        return intern(s)
+    except TypeError:
+        return s
+
+class RecordLayout(object):
+    """The field names of a group of records, shared by all records with the same fields"""
+    __slots__ = ('fields', 'index')
+    
+    def __init__(self, fields):
+        self.fields = fields
+        self.index = dict((f, n) for n, f in enumerate(fields))
+
+class Record(object):
+    """Read-only, dict-like result record of a tagged command, see P4.run(records=True).
+    Only the values are stored per record, the field names live in a shared RecordLayout."""
+    __slots__ = ('_layout', '_values')
+    
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+    
+    def __getitem__(self, key):
+        return self._values[self._layout.index[key]]
+    
+    def get(self, key, default=None):
+        n = self._layout.index.get(key)
+        return default if n is None else self._values[n]
+    
+    def __contains__(self, key):
+        return key in self._layout.index
+    
+    def __iter__(self):
+        return iter(self._layout.fields)
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def keys(self):
+        return list(self._layout.fields)
+    
+    def values(self):
+        return list(self._values)
+    
+    def items(self):
+        return list(zip(self._layout.fields, self._values))
+    
+    def as_dict(self):
+        return dict(zip(self._layout.fields, self._values))
+    
+    def __repr__(self):
+        return "Record(%r)" % self.as_dict()
+
+class RecordOutputHandler(OutputHandler):
+    """Collects tagged output as Record objects instead of dicts.
+    Field names are interned once and short values (types, actions, revisions, users...)
+    are shared between records, so large results take a fraction of the memory."""
+    
+    # Values up to this length are shared between records
+    SHARED_VALUE_LENGTH = 32
+    
+    def __init__(self):
+        OutputHandler.__init__(self)
+        self.records = []
+        self._layouts = {}
+        self._values = {}
+    
+    def _value(self, v):
+        if isinstance(v, str) and len(v) <= self.SHARED_VALUE_LENGTH:
+            return self._values.setdefault(v, v)
+        return v
+    
+    def outputStat(self, h):
+        fields = tuple(h)
+        layout = self._layouts.get(fields)
+        if layout is None:
+            layout = RecordLayout(tuple(_intern(f) for f in fields))
+            self._layouts[fields] = layout
+        self.records.append(Record(layout, tuple(self._value(h[f]) for f in fields)))
+        return OutputHandler.HANDLED
+    
+    def result(self):
+        return self.records
+
+class ColumnarOutputHandler(RecordOutputHandler):
+    """Collects tagged output as one list per field, see P4.run(records="columns").
+    Records without a field get None in its list, so all lists have the same length."""
+    
+    def __init__(self):
+        RecordOutputHandler.__init__(self)
+        self.columns = {}
+        self.rows = 0
+    
+    def outputStat(self, h):
+        for f, v in h.items():
+            column = self.columns.get(f)
+            if column is None:
+                column = self.columns[_intern(f)] = [None] * self.rows
+            column.append(self._value(v))
+        self.rows += 1
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.append(None)
+        return OutputHandler.HANDLED
+    
+    def result(self):
+        return self.columns
+
+class StreamOutputHandler(OutputHandler):
+    """Hands tagged output over to P4.stream through a bounded queue.
+    Blocks while the queue is full and cancels the command once the consumer stopped."""
+    def __init__(self, records, cancelled):
+        OutputHandler.__init__(self)
+        self.records = records
+        self.cancelled = cancelled
+    
+    def outputStat(self, h):
+        while not self.cancelled.is_set():
+            try:
+                self.records.put(h, timeout=0.1)
+                return OutputHandler.HANDLED
+            except queue.Full:
+                pass
+        return OutputHandler.CANCEL
+
 class FilelogOutputHandler(OutputHandler):
     def __init__(self):
         OutputHandler.__init__(self)
@@ -493,8 +676,13 @@ class P4(P4API.P4Adapter):
     
     def __getattr__(self, name):
         if name.startswith("run_"):
+            # Installed on the class, later lookups don't come through here again
             cmd = name[len("run_"):]
-            return lambda *args, **kargs: self.run(cmd, *args, **kargs)
+            def run_cmd(self, *args, **kargs):
+                return self.run(cmd, *args, **kargs)
+            run_cmd.__name__ = str(name)
+            setattr(P4, name, run_cmd)
+            return getattr(self, name)
         elif name.startswith("delete_"):
             cmd = name[len("delete_"):]
             return lambda *args, **kargs: self.run(cmd, "-d", *args, **kargs)
@@ -542,18 +730,93 @@ class P4(P4API.P4Adapter):
         return result[0]
     
     def __iterate(self, cmd, *args, **kargs):
+        # parallel=n fetches the specs over n extra connections
+        parallel = kargs.pop("parallel", 0)
         
         if cmd in self.specfields:
             specs = self.run(cmd, *args, **kargs)
             spec = self.specfields[cmd][0]
             field = self.specfields[cmd][1]
             
+            if parallel > 1 and len(specs) > 1:
+                return self.__iterate_parallel(spec, [ x[field] for x in specs ], parallel)
+            
             # Return a generators (Python iterator object)
             # On iteration, this will retrieve one spec at a time
             return ( self.run(spec, '-o', x[field])[0] for x in specs )
         else:
             raise Exception('Unknown spec list command: %s', cmd)
     
+    def __iterate_parallel(self, spec, names, parallel):
+        """Fetch the specs over cloned connections while yielding them in order.
+        Workers stay at most 2 * parallel specs ahead of the consumer, so stopping
+        the iteration early doesn't fetch the remaining specs."""
+        window = 2 * parallel
+        state = { "next" : 0, "yielded" : 0, "stop" : False }
+        results = {}
+        cond = threading.Condition()
+        
+        def work():
+            p4 = None
+            try:
+                while True:
+                    with cond:
+                        while not state["stop"] and state["next"] < len(names) \
+                                and state["next"] >= state["yielded"] + window:
+                            cond.wait()
+                        if state["stop"] or state["next"] >= len(names):
+                            return
+                        index = state["next"]
+                        state["next"] += 1
+                    try:
+                        if p4 is None:
+                            p4 = self.clone_connection()
+                        result = (p4.run(spec, '-o', names[index])[0], None)
+                    except Exception as e:
+                        result = (None, e)
+                    with cond:
+                        results[index] = result
+                        cond.notify_all()
+            finally:
+                if p4 is not None and p4.connected():
+                    p4.disconnect()
+        
+        threads = [ threading.Thread(target=work, name="P4Iterate") for i in range(min(parallel, len(names))) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        
+        try:
+            for index in range(len(names)):
+                with cond:
+                    while index not in results:
+                        cond.wait()
+                    value, error = results.pop(index)
+                    state["yielded"] = index + 1
+                    cond.notify_all()
+                if error is not None:
+                    raise error
+                yield value
+        finally:
+            with cond:
+                state["stop"] = True
+                cond.notify_all()
+    
+    def clone_connection(self):
+        """Returns a new connected P4 object with the settings of this one.
+        P4 objects must not be shared between threads, give each thread its own."""
+        p4 = P4(port=self.port, user=self.user, client=self.client)
+        p4.prog = self.prog
+        if self.charset:
+            p4.charset = self.charset
+        if self.password:
+            p4.password = self.password
+        p4.exception_level = self.exception_level
+        p4.tagged = self.tagged
+        p4.connect()
+        p4.cwd = self.cwd
+        return p4
+    
     def __repr__(self):
         state = "disconnected"
         if self.connected():
@@ -577,50 +840,98 @@ class P4(P4API.P4Adapter):
     
         
     def run(self, *args, **kargs):
-        "Generic run method"
-        context = {}
-        resultLogging = True
+        """Generic run method
+        
+        records=True returns the tagged output as Record objects instead of dicts,
+        records="columns" as a dict with a list of values per field.
+        """
+        if kargs:
+            records = kargs.pop("records", None)
+            if records:
+                handler = ColumnarOutputHandler() if records == "columns" else RecordOutputHandler()
+                kargs["handler"] = handler
+                self.run(*args, **kargs)
+                return handler.result()
         
-        if "resultLogging" in kargs:
-            resultLogging= False
-            del kargs["resultLogging"]
+        resultLogging = kargs.pop("resultLogging", True) is True
+        
+        # Only attributes passed for this call are saved and restored
+        context = None
+        if kargs:
+            context = {}
+            for (k,v) in list(kargs.items()):
+                context[k] = getattr(self, k)
+                setattr(self, k, v)
         
-        for (k,v) in list(kargs.items()):
-            context[k] = getattr(self, k)
-            setattr(self, k, v)
-                
         flatArgs = self.__flatten(args)
+        logger = self.logger
+        if logger and logger.isEnabledFor(logging.INFO):
+            logger.info("p4 %s", " ".join(flatArgs))
         
         # if encoding is set, translate to Bytes
-        if hasattr(self,"encoding") and self.encoding and not self.encoding == 'raw':
-            result = []
-            for s in flatArgs:
-                result.append( s.encode(self.encoding) )
-            flatArgs = result
-        
-        if self.logger:
-            self.logger.info("p4 " + " ".join(flatArgs))
+        encoding = getattr(self, "encoding", None)
+        if encoding and not encoding == 'raw':
+            flatArgs = [ s.encode(encoding) for s in flatArgs ]
         
         try:
             result = P4API.P4Adapter.run(self, *flatArgs)
         except P4Exception as e:
-            if self.logger:
+            if logger:
                 self.log_messages()
-            for (k,v) in list(context.items()):
-                setattr( self, k, v)
             raise e
+        finally:
+            if context:
+                for (k,v) in list(context.items()):
+                    setattr( self, k, v)
         
-        if self.logger:
+        if logger:
             self.log_messages()
         
-        if resultLogging and self.logger:
-            self.logger.debug(result)
-
-        for (k,v) in list(context.items()):
-            setattr( self, k, v)
-                    
+        if resultLogging and logger and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", result)
+        
         return result
     
+    def stream(self, cmd, *args, **kargs):
+        """Run a tagged command and yield each output record as soon as it arrives.
+        
+        The command runs on a separate thread, at most buffer (default 1000) records
+        are held in between. Closing the generator early cancels the command.
+        Don't use this P4 object for anything else until the generator is done.
+        """
+        records = queue.Queue(kargs.pop("buffer", 1000))
+        cancelled = threading.Event()
+        finished = object()
+        errors = []
+        kargs["handler"] = StreamOutputHandler(records, cancelled)
+        
+        def run():
+            try:
+                self.run(cmd, *args, **kargs)
+            except Exception as e:
+                errors.append(e)
+            while not cancelled.is_set():
+                try:
+                    records.put(finished, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        
+        thread = threading.Thread(target=run, name="P4Stream")
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                record = records.get()
+                if record is finished:
+                    break
+                yield record
+            if errors:
+                raise errors[0]
+        finally:
+            cancelled.set()
+            thread.join()
+    
     def run_submit(self, *args, **kargs):
         "Simplified submit - if any arguments is a dict, assume it to be the changeform"
         nargs = list(args)
@@ -716,39 +1027,56 @@ class P4(P4API.P4Adapter):
         return result
 
     def run_print(self, *args, **kargs):
+        """Print files, returning a header dict followed by the content for each file.
+        
+        With output= (a writable file object or a callable, see PrintOutputHandler)
+        the content is streamed there as it arrives and only the headers are returned.
+        """
         kargs["resultLogging"] = False
-        raw = self.run('print', args, **kargs)
+        output = kargs.pop("output", None)
 
         logger = self.logger
         if "logger" in kargs:
             logger = kargs["logger"]
 
+        if output is not None:
+            handler = PrintOutputHandler(output, getattr(self, "encoding", None))
+            self.run('print', args, handler=handler, **kargs)
+            if logger:
+                logger.debug(handler.files)
+            return handler.files
+
+        raw = self.run('print', args, **kargs)
+
         result = []
         if raw:
             debugResult = []
+            chunks = None
             for line in raw:
                 if isinstance(line, dict):
+                    if chunks is not None:
+                        result.append(self.__join_chunks(chunks))
                     result.append(line)
                     if logger:
                         debugResult.append(line)
-                    result.append("")
+                    chunks = []
                 else:
-                    # to support encoding for Python 3, we have to do a little dance
-                    # we cannot add bytes to the str "", but we expect that all lines
-                    # are either str or bytes. So if we encounter bytes, we replace the content
-                    try:
-                        result[-1] += line
-                    except TypeError:
-                        if type(line) == bytes and type(result[-1]) == str and result[-1] == "":
-                            result[-1] = line
-                        else:
-                            raise
+                    chunks.append(line)
+            if chunks is not None:
+                result.append(self.__join_chunks(chunks))
             if logger:
                 logger.debug(debugResult)
             return result
         else:
             return []
 
+    def __join_chunks(self, chunks):
+        # Joined once per file, appending chunk by chunk copies the content over and over.
+        # Chunks are either all str or all bytes (Python 3 binary files)
+        if chunks and isinstance(chunks[0], bytes):
+            return b"".join(chunks)
+        return "".join(chunks)
+
     def run_resolve(self, *args, **kargs):
         if self.resolver:
             myResolver = self.resolver
@@ -781,12 +1109,25 @@ class P4(P4API.P4Adapter):
         raise Exception("Please run P4.clone) instead")
     
     def __flatten(self, args):
-        result = []
-        if isinstance(args, tuple) or isinstance(args, list):
-            for i in args:
-                result.extend(self.__flatten(i))
+        if not isinstance(args, (tuple, list)):
+            return (args,)
+        # Most calls pass plain arguments, nothing to flatten
+        for i in args:
+            if isinstance(i, (tuple, list)):
+                break
         else:
-            result.append(args)
+            return tuple(args)
+        
+        result = []
+        stack = [ iter(args) ]
+        while stack:
+            for i in stack[-1]:
+                if isinstance(i, (tuple, list)):
+                    stack.append(iter(i))
+                    break
+                result.append(i)
+            else:
+                stack.pop()
         return tuple(result)
 
     def __enter__( self ):
@@ -887,6 +1228,123 @@ class P4(P4API.P4Adapter):
             self.delete_client(name)
             shutil.rmtree(root)
 
+class P4Pool(object):
+    """A thread safe pool of connections with the settings of a template P4 object.
+    
+    At most size connections are open at the same time, checkout() waits until one
+    is free and checkin() gives it back. connection() does both for a with block and
+    restores the context of the connection afterwards, so a caller can change cwd,
+    client, tagged etc. without affecting the next one.
+    
+    with pool.connection(exception_level=P4.RAISE_ERRORS) as p4:
+        p4.run_sync("//depot/...")
+    """
+    SIZE = 4
+    
+    def __init__(self, template, size=None):
+        self.template = template
+        self.size = size or self.SIZE
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        # clear() bumps the generation, connections from older generations aren't reused
+        self._generation = 0
+        self._checkedOut = {}
+        self._cond = threading.Condition()
+    
+    def checkout(self, timeout=None):
+        """Returns a connected P4 object, which must be given back with checkin().
+        Raises P4Exception if no connection got free within timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise P4Exception("Connection pool is closed")
+                generation = self._generation
+                if self._idle:
+                    p4 = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    p4 = None
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise P4Exception("Timed out waiting for a free connection to %s" % self.template.port)
+                self._cond.wait(remaining)
+        
+        if p4 is None or not p4.connected() or p4.dropped():
+            # New slot or a connection the server dropped while idle
+            try:
+                if p4 is not None and p4.connected():
+                    p4.disconnect()
+                p4 = self.template.clone_connection()
+            except:
+                self.__release()
+                raise
+        with self._cond:
+            self._checkedOut[id(p4)] = generation
+        return p4
+    
+    def checkin(self, p4, discard=False):
+        """Gives a connection back to the pool. Dropped connections and connections
+        given back with discard=True are closed instead of reused."""
+        reuse = not discard and p4.connected() and not p4.dropped()
+        with self._cond:
+            generation = self._checkedOut.pop(id(p4), None)
+            if reuse and not self._closed and generation == self._generation:
+                self._idle.append(p4)
+                self._cond.notify()
+                return
+        if p4.connected():
+            p4.disconnect()
+        self.__release()
+    
+    @contextmanager
+    def connection(self, timeout=None, **kargs):
+        """Checks out a connection for the block, keyword arguments are set on it
+        like in P4.saved_context"""
+        p4 = self.checkout(timeout)
+        try:
+            with p4.saved_context(**kargs):
+                yield p4
+        finally:
+            self.checkin(p4)
+    
+    def clear(self):
+        """Closes the idle connections, for example after the template's settings changed.
+        Connections that are checked out are closed once they come back."""
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for p4 in idle:
+            if p4.connected():
+                p4.disconnect()
+    
+    def close(self):
+        """Closes the idle connections and those checked out once they come back"""
+        with self._cond:
+            self._closed = True
+        self.clear()
+    
+    def __release(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+    
+    def __repr__(self):
+        return "P4Pool [%s@%s %s] %d/%d open" % \
+            (self.template.user, self.template.client, self.template.port, self._open, self.size)
+
 class Map(P4API.P4Map):
     def __init__(self, *args):
         P4API.P4Map.__init__(self, *args)
@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Ahead of anything installed, so the tests import the plugin modules and the
+# bundled P4 module rather than another P4Python's P4.py
+for path in (os.path.join(ROOT, "external_modules", "p4_api{}".format(sys.version_info[0])),
+             os.path.join(ROOT, "Scripts")):
+    if path in sys.path:
+        sys.path.remove(path)
+    sys.path.insert(0, path)
@@ -0,0 +1,77 @@
+import os
+import json
+
+from P4ConfigCache import PerforceConfigCache, mergeConfig
+
+
+class FakeCore(object):
+    """Stores the perforce section of each config file as json, counting reads and writes"""
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def getConfig(self, cat, configPath, allowCache=True):
+        self.reads += 1
+        with open(configPath) as f:
+            return json.load(f).get(cat)
+
+    def setConfig(self, data, configPath):
+        self.writes += 1
+        current = {}
+        if os.path.exists(configPath):
+            with open(configPath) as f:
+                current = json.load(f)
+        mergeConfig(current, data)
+        with open(configPath, "w") as f:
+            json.dump(current, f)
+
+
+def test_merge_config_is_recursive():
+    target = {"a": {"b": 1, "c": 2}, "d": 3}
+    mergeConfig(target, {"a": {"b": 5}, "e": 6})
+    assert target == {"a": {"b": 5, "c": 2}, "d": 3, "e": 6}
+
+
+def test_get_reads_the_file_once(tmpdir):
+    core = FakeCore()
+    cache = PerforceConfigCache(core)
+    cache.set({"shot": {".ma": "//depot/a.ma"}}, str(tmpdir))
+
+    assert cache.get("shot", str(tmpdir)) == {".ma": "//depot/a.ma"}
+    assert cache.get("shot", str(tmpdir)) == {".ma": "//depot/a.ma"}
+    assert core.reads == 1
+
+
+def test_get_rereads_a_file_changed_on_disk(tmpdir):
+    core = FakeCore()
+    cache = PerforceConfigCache(core)
+    cache.set({"shot": "a"}, str(tmpdir))
+    assert cache.get("shot", str(tmpdir)) == "a"
+
+    path = cache.getConfigPath(str(tmpdir))
+    with open(path, "w") as f:
+        json.dump({"perforce": {"shot": "changed"}}, f)
+    os.utime(path, (1, 1))
+    assert cache.get("shot", str(tmpdir)) == "changed"
+
+
+def test_missing_file_reads_as_empty(tmpdir):
+    cache = PerforceConfigCache(FakeCore())
+    assert cache.get("shot", str(tmpdir)) is None
+
+
+def test_queued_edits_are_visible_and_written_once(tmpdir):
+    core = FakeCore()
+    cache = PerforceConfigCache(core)
+    assert not cache.hasPending()
+
+    cache.queue({"shot": {".ma": "//depot/a.ma"}}, str(tmpdir))
+    cache.queue({"shot": {".mb": "//depot/a.mb"}}, str(tmpdir))
+    assert cache.hasPending()
+    assert cache.get("shot", str(tmpdir)) == {".ma": "//depot/a.ma", ".mb": "//depot/a.mb"}
+    assert core.writes == 0
+
+    cache.flush()
+    assert not cache.hasPending()
+    assert core.writes == 1
+    assert cache.get("shot", str(tmpdir)) == {".ma": "//depot/a.ma", ".mb": "//depot/a.mb"}
@@ -0,0 +1,93 @@
+import os
+import stat
+
+import pytest
+
+import P4FileUtils
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def noReflink(monkeypatch):
+    monkeypatch.setattr(P4FileUtils, "reflinkFile", lambda src, dst: False)
+
+
+def test_stage_copies_when_reflink_is_unsupported(tmpdir, noReflink):
+    src, dst = str(tmpdir.join("src.bin")), str(tmpdir.join("dst.bin"))
+    write(src, b"data" * 1000)
+
+    assert P4FileUtils.stageFile(src, dst) == "copy"
+    assert read(dst) == read(src)
+    assert not os.path.exists(dst + ".p4stage")
+
+
+def test_staged_file_never_aliases_the_source(tmpdir, noReflink):
+    src, dst = str(tmpdir.join("src.bin")), str(tmpdir.join("dst.bin"))
+    write(src, b"published")
+    os.chmod(src, stat.S_IREAD | stat.S_IWRITE)
+
+    P4FileUtils.stageFile(src, dst)
+    assert not os.path.samefile(src, dst)
+
+    # What p4 edit / sync do to the workspace file must not reach the published output
+    os.chmod(dst, stat.S_IREAD)
+    assert os.stat(src).st_mode & stat.S_IWRITE
+    os.chmod(dst, stat.S_IREAD | stat.S_IWRITE)
+    write(dst, b"changed")
+    assert read(src) == b"published"
+
+
+def test_stage_falls_back_to_copy_when_reflink_fails(tmpdir, monkeypatch):
+    def failingReflink(src, dst):
+        raise OSError("not supported")
+    monkeypatch.setattr(P4FileUtils, "reflinkFile", failingReflink)
+    src, dst = str(tmpdir.join("src.bin")), str(tmpdir.join("dst.bin"))
+    write(src, b"data")
+
+    assert P4FileUtils.stageFile(src, dst) == "copy"
+    assert read(dst) == b"data"
+
+
+def test_stage_replaces_a_read_only_target(tmpdir, noReflink):
+    src, dst = str(tmpdir.join("src.bin")), str(tmpdir.join("dst.bin"))
+    write(src, b"new")
+    write(dst, b"old")
+    os.chmod(dst, stat.S_IREAD)
+
+    P4FileUtils.stageFile(src, dst)
+    assert read(dst) == b"new"
+
+
+def test_copy_file_digest_matches_fstat(tmpdir):
+    src, dst = str(tmpdir.join("src.bin")), str(tmpdir.join("dst.bin"))
+    write(src, b"hello")
+    progress = []
+
+    digest = P4FileUtils.copyFile(src, dst, callback=progress.append, digest=True)
+    assert digest == "5D41402ABC4B2A76B9719D911017C592"
+    assert progress == [5]
+
+
+def test_run_parallel_keeps_item_order():
+    done = []
+    results = P4FileUtils.runParallel(lambda x: x * 2, range(20), workers=4, callback=done.append)
+    assert results == [x * 2 for x in range(20)]
+    assert sorted(done) == list(range(1, 21))
+
+
+def test_run_parallel_raises_the_first_error():
+    def func(x):
+        if x == 3:
+            raise IOError("broken")
+        return x
+    with pytest.raises(IOError):
+        P4FileUtils.runParallel(func, range(10), workers=4)
@@ -0,0 +1,30 @@
+import os
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by path, the perforce package itself needs Qt and the bundled P4API
+spec = importlib.util.spec_from_file_location("FstatFilter", os.path.join(
+    ROOT, "external_modules", "p4_api2", "perforce", "PerforceUtils", "FstatFilter.py"))
+FstatFilter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(FstatFilter)
+
+
+def test_escape_filter_value():
+    assert FstatFilter.escapeFilterValue("//depot/a b/c=d(1)|^x") == r"//depot/a\ b/c\=d\(1\)\|\^x"
+    assert FstatFilter.escapeFilterValue("//depot/plain/file.ma") == "//depot/plain/file.ma"
+    assert FstatFilter.escapeFilterValue("a\\b") == "a\\\\b"
+
+
+def test_client_view_hides_deleted_files_but_keeps_opened_ones():
+    expr = FstatFilter.fstatFilter(True)
+    assert expr == "^action=delete ^action=move/delete (action=* | (^headAction=delete ^headAction=move/delete))"
+
+
+def test_depot_view_lists_everything():
+    assert FstatFilter.fstatFilter(False) == ""
+
+
+def test_type_filter_and_paging_are_combined():
+    expr = FstatFilter.fstatFilter(False, typeFilter="binary", after="//depot/my file.ma")
+    assert expr == r"(headType=*binary* | type=*binary*) depotFile>//depot/my\ file.ma"
@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("P4")
+from P4HaveCache import HaveListCache
+
+
+class FakeP4(object):
+    port = "perforce:1666"
+    client = "client"
+    server_case_insensitive = False
+
+    def __init__(self, revs):
+        # depotFile: (haveRev, headRev)
+        self.revs = revs
+        self.fstats = []
+
+    @contextmanager
+    def at_exception_level(self, level):
+        yield
+
+    def run_fstat(self, *args):
+        files = args[-1]
+        self.fstats.append(files)
+        return [{"depotFile": f, "haveRev": str(self.revs[f][0]), "headRev": str(self.revs[f][1]), "headAction": "edit"}
+                for f in files if f in self.revs]
+
+
+def test_only_outdated_files_are_returned():
+    p4 = FakeP4({"//depot/a": (1, 1), "//depot/b": (1, 2)})
+    cache = HaveListCache()
+    assert cache.outdated(p4, ["//depot/a", "//depot/b"]) == ["//depot/b"]
+
+
+def test_entries_are_cached_until_the_ttl():
+    p4 = FakeP4({"//depot/a": (1, 1)})
+    cache = HaveListCache(ttl=60)
+    cache.outdated(p4, ["//depot/a"])
+    cache.outdated(p4, ["//depot/a"])
+    assert len(p4.fstats) == 1
+
+    expired = HaveListCache(ttl=0)
+    expired.outdated(p4, ["//depot/a"])
+    expired.outdated(p4, ["//depot/a"])
+    assert len(p4.fstats) == 3
+
+
+def test_synced_output_updates_the_entries():
+    p4 = FakeP4({"//depot/b": (1, 2)})
+    cache = HaveListCache()
+    assert cache.outdated(p4, ["//depot/b"]) == ["//depot/b"]
+
+    cache.synced([{"depotFile": "//depot/b", "rev": "2", "action": "updated"}])
+    assert cache.outdated(p4, ["//depot/b"]) == []
+    assert len(p4.fstats) == 1
+
+
+def test_deleted_heads_are_outdated():
+    p4 = FakeP4({"//depot/c": (3, 4)})
+    p4.run_fstat = lambda *args: [{"depotFile": "//depot/c", "haveRev": "3", "headRev": "4", "headAction": "delete"}]
+    assert HaveListCache().outdated(p4, ["//depot/c"]) == ["//depot/c"]
+
+
+def test_changing_client_clears_the_cache():
+    p4 = FakeP4({"//depot/a": (1, 1)})
+    cache = HaveListCache()
+    cache.outdated(p4, ["//depot/a"])
+    p4.client = "other"
+    cache.outdated(p4, ["//depot/a"])
+    assert len(p4.fstats) == 2
+
+
+def test_case_insensitive_servers_match_any_case():
+    p4 = FakeP4({"//Depot/A": (1, 2)})
+    p4.server_case_insensitive = True
+    cache = HaveListCache()
+    cache.outdated(p4, ["//Depot/A"])
+    cache.synced([{"depotFile": "//depot/a", "rev": "2"}])
+    assert cache.outdated(p4, ["//DEPOT/A"]) == []
+    assert len(p4.fstats) == 1
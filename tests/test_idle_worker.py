@@ -0,0 +1,74 @@
+import os
+import threading
+import importlib.util
+
+import pytest
+
+from P4IdleWorker import P4IdleWorker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by path, the perforce package itself needs Qt and the bundled P4API
+spec = importlib.util.spec_from_file_location("IdleWorker", os.path.join(
+    ROOT, "external_modules", "p4_api2", "perforce", "PerforceUtils", "IdleWorker.py"))
+IdleWorker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(IdleWorker)
+
+
+@pytest.fixture(params=["plugin", "bundled"])
+def workerClass(request):
+    return P4IdleWorker if request.param == "plugin" else IdleWorker.IdleWorker
+
+
+def test_items_are_handled_in_order(workerClass):
+    handled = []
+    done = threading.Event()
+
+    def handle(item):
+        handled.append(item)
+        if len(handled) == 3:
+            done.set()
+
+    worker = workerClass(handle, "Test")
+    for item in range(3):
+        worker.put(item)
+    assert done.wait(5)
+    assert handled == [0, 1, 2]
+
+
+def test_thread_ends_while_idle_and_restarts(workerClass):
+    handled = threading.Semaphore(0)
+    worker = workerClass(lambda item: handled.release(), "Test", idleTimeout=0.05)
+
+    worker.put(1)
+    assert handled.acquire(timeout=5)
+    worker._thread.join(5)
+    assert not worker.isRunning()
+
+    worker.put(2)
+    assert handled.acquire(timeout=5)
+
+
+def test_failing_item_doesnt_stop_the_worker(workerClass):
+    handled = threading.Semaphore(0)
+
+    def handle(item):
+        if item == "bad":
+            raise RuntimeError(item)
+        handled.release()
+
+    worker = workerClass(handle, "Test")
+    worker.put("bad")
+    worker.put("good")
+    assert handled.acquire(timeout=5)
+
+
+def test_latest_item_keeps_only_the_newest():
+    items = IdleWorker.LatestItem()
+    assert items.empty()
+    items.put("a")
+    items.put("b")
+    assert items.get(timeout=0) == "b"
+    assert items.empty()
+    with pytest.raises(IdleWorker.queue.Empty):
+        items.get(timeout=0.01)
@@ -0,0 +1,145 @@
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+P4 = pytest.importorskip("P4")
+from P4ConnectionPool import P4ConnectionPool
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.open = True
+        self.lost = False
+        self.cwd = "/root"
+
+    def connected(self):
+        return self.open
+
+    def dropped(self):
+        return self.lost
+
+    def disconnect(self):
+        self.open = False
+
+    @contextmanager
+    def saved_context(self, **kargs):
+        saved = self.cwd
+        for key, value in kargs.items():
+            setattr(self, key, value)
+        try:
+            yield
+        finally:
+            self.cwd = saved
+
+
+class FakeTemplate(object):
+    port = "perforce:1666"
+    user = "user"
+    client = "client"
+
+    def __init__(self):
+        self.clones = []
+
+    def clone_connection(self):
+        p4 = FakeConnection()
+        self.clones.append(p4)
+        return p4
+
+
+@pytest.fixture(params=["plugin", "bundled"])
+def makePool(request):
+    """Both pools: the plugin's P4ConnectionPool and P4.P4Pool used by the perforce windows"""
+    def make(template, size):
+        if request.param == "plugin":
+            return P4ConnectionPool(lambda: template.clone_connection(), size=size)
+        return P4.P4Pool(template, size=size)
+    return make
+
+
+def test_connections_are_reused(makePool):
+    template = FakeTemplate()
+    pool = makePool(template, size=2)
+
+    p4 = pool.checkout()
+    pool.checkin(p4)
+    assert pool.checkout() is p4
+    assert len(template.clones) == 1
+
+
+def test_checkout_waits_for_a_free_connection(makePool):
+    pool = makePool(FakeTemplate(), size=1)
+    p4 = pool.checkout()
+
+    with pytest.raises(P4.P4Exception):
+        pool.checkout(timeout=0.05)
+
+    timer = threading.Timer(0.05, pool.checkin, (p4,))
+    timer.start()
+    assert pool.checkout(timeout=5) is p4
+    timer.join()
+
+
+def test_connection_restores_the_context(makePool):
+    pool = makePool(FakeTemplate(), size=1)
+    with pool.connection(cwd="/elsewhere") as p4:
+        assert p4.cwd == "/elsewhere"
+    assert p4.cwd == "/root"
+    with pool.connection() as again:
+        assert again is p4
+
+
+def test_connection_is_returned_when_the_block_raises(makePool):
+    pool = makePool(FakeTemplate(), size=1)
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError()
+    pool.checkin(pool.checkout(timeout=0))
+
+
+def test_dropped_connections_are_replaced(makePool):
+    template = FakeTemplate()
+    pool = makePool(template, size=1)
+    p4 = pool.checkout()
+    p4.lost = True
+    pool.checkin(p4)
+
+    assert not p4.connected()
+    assert pool.checkout(timeout=0) is not p4
+    assert len(template.clones) == 2
+
+
+def test_clear_retires_checked_out_connections(makePool):
+    pool = makePool(FakeTemplate(), size=2)
+    idle = pool.checkout()
+    busy = pool.checkout()
+    pool.checkin(idle)
+
+    pool.clear()
+    assert not idle.connected()
+    pool.checkin(busy)
+    assert not busy.connected()
+    fresh = pool.checkout(timeout=0)
+    assert fresh is not idle and fresh is not busy
+
+
+def test_failed_clone_frees_the_slot(makePool):
+    template = FakeTemplate()
+    pool = makePool(template, size=1)
+    template.clone_connection = lambda: (_ for _ in ()).throw(P4.P4Exception("offline"))
+    with pytest.raises(P4.P4Exception):
+        pool.checkout()
+
+    del template.clone_connection
+    pool.checkin(pool.checkout(timeout=0))
+
+
+def test_closed_pool_refuses_checkouts(makePool):
+    pool = makePool(FakeTemplate(), size=1)
+    p4 = pool.checkout()
+    pool.close()
+
+    with pytest.raises(P4.P4Exception):
+        pool.checkout()
+    pool.checkin(p4)
+    assert not p4.connected()
@@ -0,0 +1,52 @@
+import pytest
+
+P4 = pytest.importorskip("P4")
+
+
+def stats():
+    # Separate string objects, like the values coming from the server
+    return [{"depotFile": "//depot/a", "headType": "".join(["bin", "ary"]), "headRev": "1"},
+            {"depotFile": "//depot/b", "headType": "".join(["bin", "ary"]), "headRev": "2"},
+            {"depotFile": "//depot/c", "headRev": "3"}]
+
+
+def test_records_behave_like_dicts():
+    handler = P4.RecordOutputHandler()
+    for h in stats():
+        handler.outputStat(h)
+    a, b, c = handler.result()
+
+    assert a["depotFile"] == "//depot/a"
+    assert b.get("headType") == "binary"
+    assert c.get("headType", "text") == "text"
+    assert "headType" not in c
+    assert a.as_dict() == stats()[0]
+    assert sorted(a.keys()) == sorted(stats()[0].keys())
+    assert dict(c.items()) == stats()[2]
+    with pytest.raises(KeyError):
+        c["headType"]
+
+
+def test_records_share_layouts_and_short_values():
+    handler = P4.RecordOutputHandler()
+    for h in stats():
+        handler.outputStat(h)
+    a, b, c = handler.result()
+
+    assert a._layout is b._layout
+    assert a._layout is not c._layout
+    assert a["headType"] is b["headType"]
+
+
+def test_columns_are_padded_for_missing_fields():
+    handler = P4.ColumnarOutputHandler()
+    for h in stats():
+        handler.outputStat(h)
+    columns = handler.result()
+
+    assert columns["depotFile"] == ["//depot/a", "//depot/b", "//depot/c"]
+    assert columns["headType"] == ["binary", "binary", None]
+
+    handler.outputStat({"depotFile": "//depot/d", "action": "edit"})
+    assert handler.result()["action"] == [None, None, None, "edit"]
+    assert len(handler.result()["headRev"]) == 4
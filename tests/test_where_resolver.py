@@ -0,0 +1,73 @@
+import os
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("P4")
+from P4WhereResolver import WhereResolver
+
+
+class FakeP4(object):
+    port = "perforce:1666"
+    client = "ws"
+
+    def __init__(self, root="/work/ws"):
+        self.root = root
+        self.update = "2024/01/01 00:00:00"
+        self.fetches = 0
+        self.wheres = []
+
+    @contextmanager
+    def at_exception_level(self, level):
+        yield
+
+    def fetch_client(self, name):
+        self.fetches += 1
+        return {"Root": self.root, "Update": self.update, "View": ["//depot/project/... //ws/project/..."]}
+
+    def run_where(self, path):
+        self.wheres.append(path)
+        return [{"depotFile": "//depot/other/x", "clientFile": "//ws/other/x", "path": "/elsewhere/x"}]
+
+
+def test_paths_resolve_from_the_client_view():
+    p4 = FakeP4()
+    result = WhereResolver().where(p4, "//depot/project/a.ma")
+    assert result == {"depotFile": "//depot/project/a.ma",
+                      "clientFile": "//ws/project/a.ma",
+                      "path": os.path.normpath("/work/ws/project/a.ma")}
+    assert p4.wheres == []
+
+
+def test_client_and_local_paths_resolve_to_the_depot():
+    p4 = FakeP4()
+    resolver = WhereResolver()
+    assert resolver.where(p4, "//ws/project/a.ma")["depotFile"] == "//depot/project/a.ma"
+    assert resolver.where(p4, "/work/ws/project/a.ma")["depotFile"] == "//depot/project/a.ma"
+
+
+def test_unmapped_paths_ask_the_server():
+    p4 = FakeP4()
+    assert WhereResolver().where(p4, "//depot/other/x")["path"] == "/elsewhere/x"
+    assert p4.wheres == ["//depot/other/x"]
+
+
+def test_client_spec_is_fetched_once_per_interval():
+    p4 = FakeP4()
+    resolver = WhereResolver(checkInterval=60)
+    resolver.where(p4, "//depot/project/a.ma")
+    resolver.where(p4, "//depot/project/b.ma")
+    assert p4.fetches == 1
+
+    resolver.invalidate()
+    p4.root = "/moved/ws"
+    assert resolver.where(p4, "//depot/project/a.ma")["path"] == os.path.normpath("/moved/ws/project/a.ma")
+    assert p4.fetches == 2
+
+
+def test_where_many_batches_the_misses():
+    p4 = FakeP4()
+    results = WhereResolver().whereMany(p4, ["//depot/project/a.ma", "//depot/other/x", "//depot/none"])
+
+    assert sorted(results) == ["//depot/other/x", "//depot/project/a.ma"]
+    assert p4.wheres == [["//depot/other/x", "//depot/none"]]